@@ -113,15 +113,15 @@ def build_prompts_from_markdown(input_folder: Path, output_folder: Path):
         intro = subsections[0]
         intro_text = intro["subtitle"] + "\n\n" + intro["content"]
         
+        # Task instructions and introduction are shared by every subsection of
+        # the paper: send them as a common prefix so the server caches them
+        prefix = template.replace("{{paper}}", f"--- INTRODUCTION ---\n\n{intro_text}\n\n")
+
         for subsection in subsections[1:]:
             subtext = subsection["subtitle"] + "\n\n" + subsection["content"]
-            prompt_body = (
-                f"--- INTRODUCTION ---\n\n{intro_text}\n\n"
-                f"--- RESULTS ---\n\n{subtext}"
-            )
-            prompt = template.replace("{{paper}}", prompt_body)
             prompts.append({
-                "prompt": prompt,
+                "prefix": prefix,
+                "prompt": f"--- RESULTS ---\n\n{subtext}",
                 "text": subtext,
                 "from": str(md_file)
             })
@@ -279,6 +279,16 @@ def main():
         action="store_true",
         help="Skip inference and only aggregate existing results"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only send prompts without a response in the existing responses.jsonl"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the response cache configured in the model YAML"
+    )
     args = parser.parse_args()
 
     input_folder = args.input_folder.resolve()
@@ -303,7 +313,9 @@ def main():
         run_inference(
             str(config_path),
             str(prompts_file),
-            str(responses_file)
+            str(responses_file),
+            resume=args.resume,
+            use_cache=not args.no_cache
         )
 
     # 3. Parse results
@@ -0,0 +1,586 @@
+"""
+Minimal local stand-in for a vLLM or Gemini server, for benchmarking the
+inference clients without a GPU or an API key.
+
+Speaks HTTP/1.1 with keep-alive, accepts gzip-compressed request bodies and
+answers OpenAI chat.completion requests on `/v1/chat/completions` and Gemini
+GenerateContentResponse requests on `:generateContent` and
+`:streamGenerateContent` paths. `GET /health` returns 200.
+
+Each generation waits for a first-token latency drawn from `latency_dist`
+(`fixed`, `exponential` or `lognormal` around a mean of `latency` seconds),
+then produces `output_tokens` tokens at `tokens_per_second` (0: instantly),
+for each of the `n` (chat) or `candidateCount` (Gemini) samples requested.
+Streamed responses (`"stream": true`, or `:streamGenerateContent?alt=sse`)
+send server-sent events every 50 ms as the tokens are produced. Faults are
+injected at random: `error_429_rate` (with `Retry-After`), `error_500_rate`
+and `hang_rate`, the latter holding the request for `hang_seconds` so that
+client timeouts fire.
+
+The Gemini Files API and context caching are mimicked too: resumable uploads
+to `/upload/v1beta/files`, `GET /v1beta/files/<id>`, creating and deleting
+`/v1beta/cachedContents`; `fileData.fileUri` and `cachedContent` references in
+generate requests are checked, and token counts are estimated at 4 characters
+per token so cached-token savings show up in the usage metadata.
+
+A fake Batch API runs `:batchGenerateContent` jobs over an uploaded JSONL
+input file: jobs stay pending for `batch_delay` seconds, then write a
+responses file downloadable from `/download/v1beta/files/<id>:download`, and
+are polled with `GET /v1beta/batches/<id>`.
+
+With `max_model_len`, chat completions whose prompt plus `max_tokens` exceed
+it are answered 400 as vLLM does; the window is reported by `GET /v1/models`
+and, as `inputTokenLimit`, by `GET /v1beta/models/<model>`.
+
+Chat completions can simulate vLLM's automatic prefix caching: with
+`prefix_cache_blocks`, prompts are split into blocks of 64 characters kept in
+an LRU cache, and only the uncached part of a prompt costs
+`prefill_per_1k_tokens` seconds of prefill before the first token, so time to
+first token reflects cache reuse.
+
+Usage:
+python -m src.benchmark.mock_server --port 8899 --latency 0.5 --latency-dist lognormal \
+    --output-tokens 200 --tokens-per-second 50 --error-429-rate 0.02
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+
+PREFIX_BLOCK_CHARS = 64
+# Seconds between two streamed events
+STREAM_INTERVAL = 0.05
+WORDS = ("mock", "response")
+# Gemini model limits reported without `max_model_len`
+GEMINI_INPUT_TOKEN_LIMIT = 1048576
+GEMINI_OUTPUT_TOKEN_LIMIT = 65536
+
+
+def mock_text(tokens, start=0):
+    return " ".join(WORDS[i % len(WORDS)] for i in range(start, start + tokens))
+
+
+def chat_usage(prompt_tokens=1, cached_tokens=0, completion_tokens=1):
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if cached_tokens:
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+    return usage
+
+
+def sample_texts(tokens, samples, start=0):
+    """One text per requested sample; odd samples start on the other word, so they disagree."""
+    return [mock_text(tokens, start + k) for k in range(samples)]
+
+
+def chat_completion(texts, prompt_tokens=1, cached_tokens=0, completion_tokens=1):
+    return {
+        "object": "chat.completion",
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": text, "reasoning_content": None},
+                "finish_reason": "stop",
+            }
+            for i, text in enumerate(texts)
+        ],
+        "usage": chat_usage(prompt_tokens, cached_tokens, completion_tokens),
+    }
+
+
+def chat_completion_chunk(text=None, finish_reason=None, usage=None, index=0):
+    if usage:
+        return {"object": "chat.completion.chunk", "choices": [], "usage": usage}
+    delta = {"content": text} if text else {}
+    return {"object": "chat.completion.chunk", "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}]}
+
+
+def gemini_usage_metadata(prompt_tokens=1, cached_tokens=0, completion_tokens=1):
+    usage = {
+        "promptTokenCount": prompt_tokens + cached_tokens,
+        "candidatesTokenCount": completion_tokens,
+        "totalTokenCount": prompt_tokens + cached_tokens + completion_tokens,
+    }
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    return usage
+
+
+def generate_content(texts, prompt_tokens=1, cached_tokens=0, completion_tokens=1, finish_reason="STOP", usage=True):
+    response = {
+        "candidates": [
+            {"content": {"parts": [{"text": text}], "role": "model"}, "index": i}
+            for i, text in enumerate(texts)
+        ],
+    }
+    if finish_reason:
+        for candidate in response["candidates"]:
+            candidate["finishReason"] = finish_reason
+    if usage:
+        response["usageMetadata"] = gemini_usage_metadata(prompt_tokens, cached_tokens, completion_tokens)
+    return response
+
+
+def count_text_tokens(contents):
+    chars = sum(len(part.get("text", "")) for content in contents for part in content.get("parts", []))
+    return max(1, chars // 4)
+
+
+class RawBody:
+    """A response body sent as is, e.g. a file download."""
+
+    def __init__(self, data, content_type="application/octet-stream"):
+        self.data = data
+        self.content_type = content_type
+
+
+class EventStream:
+    """A response sent as server-sent events with chunked transfer encoding."""
+
+    def __init__(self, events, done_marker=True):
+        """
+        :param events: Async iterable of JSON-serialisable events.
+        :param done_marker: End with `data: [DONE]` like OpenAI (Gemini does not).
+        """
+        self.events = events
+        self.done_marker = done_marker
+
+
+class MockServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, prefill_per_1k_tokens=0.0, prefix_cache_blocks=0,
+                 batch_delay=1.0, latency_dist="fixed", latency_sigma=0.5, output_tokens=2, tokens_per_second=0.0,
+                 error_429_rate=0.0, error_500_rate=0.0, hang_rate=0.0, hang_seconds=600.0, seed=None,
+                 max_model_len=None):
+        if latency_dist not in ("fixed", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {latency_dist}")
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.output_tokens = output_tokens
+        self.tokens_per_second = tokens_per_second
+        self.error_429_rate = error_429_rate
+        self.error_500_rate = error_500_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.max_model_len = max_model_len
+        self._rng = random.Random(seed)
+        self.faults = Counter()
+        self.batch_delay = batch_delay
+        self.batches = {}
+        self._file_data = {}
+        self._batch_tasks = set()
+        self.prefill_per_1k_tokens = prefill_per_1k_tokens
+        self.prefix_cache_blocks = prefix_cache_blocks
+        self._prefix_cache = OrderedDict()
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.connections = 0
+        self.requests = 0
+        self.bytes_received = 0
+        self.files = {}
+        self.cached_contents = {}
+        self._uploads = {}
+        self._ids = itertools.count(1)
+        self._server = None
+
+    async def __aenter__(self):
+        # A deep accept queue, or a burst of new connections waits for SYN retransmits
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        # Port 0 picks a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.bytes_received += len(body)
+                if headers.get("content-encoding") == "gzip":
+                    body = gzip.decompress(body)
+
+                status, payload, extra_headers = await self._respond(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                extra = "".join(f"{name}: {value}\r\n" for name, value in extra_headers.items())
+                connection = f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                if isinstance(payload, EventStream):
+                    writer.write(
+                        f"HTTP/1.1 {status}\r\n"
+                        "Content-Type: text/event-stream\r\n"
+                        "Transfer-Encoding: chunked\r\n"
+                        f"{extra}{connection}".encode("latin-1")
+                    )
+
+                    def send_event(data):
+                        chunk = f"data: {data}\n\n".encode("utf-8")
+                        writer.write(f"{len(chunk):x}\r\n".encode("latin-1") + chunk + b"\r\n")
+
+                    async for event in payload.events:
+                        send_event(json.dumps(event))
+                        await writer.drain()
+                    if payload.done_marker:
+                        send_event("[DONE]")
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    content_type = payload.content_type if isinstance(payload, RawBody) else "application/json"
+                    data = payload.data if isinstance(payload, RawBody) else json.dumps(payload).encode("utf-8")
+                    writer.write(
+                        f"HTTP/1.1 {status}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"{extra}{connection}".encode("latin-1")
+                        + data
+                    )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def _respond(self, method, path, headers, body):
+        if method == "GET" and path == "/health":
+            return "200 OK", {}, {}
+        if method == "GET" and path == "/v1/models":
+            model = {"id": "mock", "object": "model", "max_model_len": self.max_model_len}
+            return "200 OK", {"object": "list", "data": [model]}, {}
+        if method == "GET" and path.startswith("/v1beta/models/"):
+            model = {
+                "name": path[len("/v1beta/"):],
+                "inputTokenLimit": self.max_model_len or GEMINI_INPUT_TOKEN_LIMIT,
+                "outputTokenLimit": GEMINI_OUTPUT_TOKEN_LIMIT,
+            }
+            return "200 OK", model, {}
+        if path.startswith("/upload/v1beta/files"):
+            return self._upload(path, headers, body)
+        if method == "GET" and path.startswith("/v1beta/files/"):
+            name = path[len("/v1beta/"):]
+            if name not in self.files:
+                return "404 Not Found", {"error": {"message": f"File {name} not found"}}, {}
+            return "200 OK", self.files[name], {}
+        if path.startswith("/v1beta/cachedContents"):
+            return self._cached_contents(method, path, body)
+        if method == "GET" and path.startswith("/download/v1beta/files/"):
+            name = path[len("/download/v1beta/"):].split(":", 1)[0]
+            if name not in self._file_data:
+                return "404 Not Found", {"error": {"message": f"File {name} not found"}}, {}
+            return "200 OK", RawBody(self._file_data[name]), {}
+        if method == "GET" and path.startswith("/v1beta/batches/"):
+            name = path[len("/v1beta/"):]
+            if name not in self.batches:
+                return "404 Not Found", {"error": {"message": f"Batch {name} not found"}}, {}
+            return "200 OK", self.batches[name], {}
+        if method != "POST":
+            return "405 Method Not Allowed", {"error": {"message": "POST only"}}, {}
+        payload = json.loads(body or b"{}")
+        if ":batchGenerateContent" in path:
+            return self._create_batch(path, payload)
+        return await self._generate(path, payload)
+
+    def _sample_latency(self):
+        if self.latency <= 0 or self.latency_dist == "fixed":
+            return self.latency
+        if self.latency_dist == "exponential":
+            return self._rng.expovariate(1 / self.latency)
+        # Lognormal with mean `latency`
+        mu = math.log(self.latency) - self.latency_sigma ** 2 / 2
+        return self._rng.lognormvariate(mu, self.latency_sigma)
+
+    async def _inject_fault(self):
+        """An error response for a randomly chosen fraction of requests, else None."""
+        draw = self._rng.random()
+        if draw < self.error_429_rate:
+            self.faults["429"] += 1
+            error = {"code": 429, "message": "Resource has been exhausted (mock)", "status": "RESOURCE_EXHAUSTED"}
+            return "429 Too Many Requests", {"error": error}, {"Retry-After": "1"}
+        draw -= self.error_429_rate
+        if draw < self.error_500_rate:
+            self.faults["500"] += 1
+            error = {"code": 500, "message": "Internal error (mock)", "status": "INTERNAL"}
+            return "500 Internal Server Error", {"error": error}, {}
+        draw -= self.error_500_rate
+        if draw < self.hang_rate:
+            self.faults["hang"] += 1
+            # Long enough for the client to time out and give up
+            await asyncio.sleep(self.hang_seconds)
+            error = {"code": 504, "message": "Deadline exceeded (mock)", "status": "DEADLINE_EXCEEDED"}
+            return "504 Gateway Timeout", {"error": error}, {}
+        return None
+
+    async def _generate(self, path, payload):
+        self.requests += 1
+        fault = await self._inject_fault()
+        if fault:
+            return fault
+        gemini = ":generateContent" in path or ":streamGenerateContent" in path
+        if gemini:
+            error, prompt_tokens, cached_tokens = self._check_gemini_request(payload)
+            if error:
+                return error[0], error[1], {}
+            stream = ":streamGenerateContent" in path
+            samples = (payload.get("generationConfig") or {}).get("candidateCount") or 1
+        else:
+            prompt = "".join(
+                message.get("content") for message in payload.get("messages", [])
+                if isinstance(message.get("content"), str)
+            )
+            prompt_tokens = max(1, len(prompt) // 4)
+            requested = prompt_tokens + (payload.get("max_tokens") or 0)
+            if self.max_model_len and requested > self.max_model_len:
+                message = (
+                    f"This model's maximum context length is {self.max_model_len} tokens. However, you requested "
+                    f"{requested} tokens ({prompt_tokens} in the messages, {payload.get('max_tokens') or 0} in the completion)."
+                )
+                return "400 Bad Request", {"object": "error", "message": message, "type": "BadRequestError", "code": 400}, {}
+            cached_tokens = self._prefix_cache_lookup(prompt) // 4
+            stream = payload.get("stream")
+            samples = payload.get("n") or 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_prompt_tokens += cached_tokens
+
+        first_token = self._sample_latency() + (prompt_tokens - cached_tokens) / 1000 * self.prefill_per_1k_tokens
+        n = self.output_tokens
+        if stream:
+            events = self._stream_events(gemini, first_token, n, samples, prompt_tokens, cached_tokens)
+            return "200 OK", EventStream(events, done_marker=not gemini), {}
+        # Samples are decoded in parallel, as in one batch
+        await asyncio.sleep(first_token + (n / self.tokens_per_second if self.tokens_per_second else 0))
+        texts = sample_texts(n, samples)
+        if gemini:
+            # Gemini counts cached tokens on top of the text sent
+            return "200 OK", generate_content(texts, prompt_tokens, cached_tokens, n * samples), {}
+        return "200 OK", chat_completion(texts, prompt_tokens, cached_tokens, n * samples), {}
+
+    async def _stream_events(self, gemini, first_token, n, samples, prompt_tokens, cached_tokens):
+        """Events carrying the generated tokens as they would be produced, then the finish reason and usage."""
+        await asyncio.sleep(first_token)
+        per_event = max(1, round(self.tokens_per_second * STREAM_INTERVAL)) if self.tokens_per_second else n
+        sent = 0
+        while sent < n:
+            count = min(per_event, n - sent)
+            if sent and self.tokens_per_second:
+                await asyncio.sleep(count / self.tokens_per_second)
+            separator = " " if sent + count < n else ""
+            texts = [text + separator for text in sample_texts(count, samples, sent)]
+            sent += count
+            if gemini:
+                # The last chunk carries the finish reason and usage
+                last = sent == n
+                yield generate_content(
+                    texts, prompt_tokens, cached_tokens, n * samples, finish_reason="STOP" if last else None, usage=last
+                )
+            else:
+                for index, text in enumerate(texts):
+                    yield chat_completion_chunk(text, index=index)
+        if not gemini:
+            for index in range(samples):
+                yield chat_completion_chunk(finish_reason="stop", index=index)
+            yield chat_completion_chunk(usage=chat_usage(prompt_tokens, cached_tokens, n * samples))
+
+    def _check_gemini_request(self, payload):
+        """`(error, prompt_tokens, cached_tokens)`, `error` being `(status, body)` for dangling references."""
+        cached_tokens = 0
+        if payload.get("cachedContent"):
+            cached = self.cached_contents.get(payload["cachedContent"])
+            if cached is None:
+                message = f"CachedContent not found (or permission denied): {payload['cachedContent']}"
+                return ("403 Forbidden", {"error": {"code": 403, "message": message}}), 0, 0
+            cached_tokens = cached["usageMetadata"]["totalTokenCount"]
+        for content in payload.get("contents", []):
+            for part in content.get("parts", []):
+                uri = part.get("fileData", {}).get("fileUri")
+                if uri and uri.rsplit("/v1beta/", 1)[-1] not in self.files:
+                    message = f"You do not have permission to access the File {uri} or it may not exist."
+                    return ("403 Forbidden", {"error": {"code": 403, "message": message}}), 0, 0
+        return None, count_text_tokens(payload.get("contents", [])), cached_tokens
+
+    def _generate_content(self, payload):
+        """Immediate answer to one request of a batch job."""
+        error, prompt_tokens, cached_tokens = self._check_gemini_request(payload)
+        if error:
+            return error
+        n = self.output_tokens
+        samples = (payload.get("generationConfig") or {}).get("candidateCount") or 1
+        return "200 OK", generate_content(sample_texts(n, samples), prompt_tokens, cached_tokens, n * samples)
+
+    def _create_batch(self, path, payload):
+        input_file = payload.get("batch", {}).get("input_config", {}).get("file_name")
+        if input_file not in self._file_data:
+            return "400 Bad Request", {"error": {"message": f"Input file {input_file} not found"}}, {}
+        name = f"batches/mock{next(self._ids)}"
+        self.batches[name] = {
+            "name": name,
+            "metadata": {
+                "@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                "name": name,
+                "model": path.split("/models/", 1)[-1].split(":", 1)[0],
+                "state": "BATCH_STATE_PENDING",
+            },
+            "done": False,
+        }
+        task = asyncio.ensure_future(self._run_batch(name, self._file_data[input_file]))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+        return "200 OK", self.batches[name], {}
+
+    async def _run_batch(self, name, input_data):
+        await asyncio.sleep(self.batch_delay / 2)
+        self.batches[name]["metadata"]["state"] = "BATCH_STATE_RUNNING"
+        await asyncio.sleep(self.batch_delay / 2)
+        lines = []
+        for line in input_data.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            self.requests += 1
+            status, response = self._generate_content(item["request"])
+            outcome = {"response": response} if status.startswith("200") else {"error": response["error"]}
+            lines.append(json.dumps({"key": item["key"], **outcome}))
+        output = f"files/mock{next(self._ids)}"
+        self._file_data[output] = ("\n".join(lines) + "\n").encode("utf-8")
+        self.batches[name]["metadata"]["state"] = "BATCH_STATE_SUCCEEDED"
+        self.batches[name]["done"] = True
+        self.batches[name]["response"] = {
+            "@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatchOutput",
+            "responsesFile": output,
+        }
+
+    def _prefix_cache_lookup(self, prompt):
+        """Characters of `prompt` served from the simulated prefix cache, which then holds all of it."""
+        if not self.prefix_cache_blocks:
+            return 0
+        h = hashlib.sha256()
+        cached_chars = 0
+        hit = True
+        for start in range(0, len(prompt) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+            # Like vLLM, a block is identified by its content and everything before it
+            h.update(prompt[start:start + PREFIX_BLOCK_CHARS].encode("utf-8"))
+            block = h.copy().digest()
+            if hit and block in self._prefix_cache:
+                cached_chars += PREFIX_BLOCK_CHARS
+            else:
+                hit = False
+            self._prefix_cache[block] = True
+            self._prefix_cache.move_to_end(block)
+        while len(self._prefix_cache) > self.prefix_cache_blocks:
+            self._prefix_cache.popitem(last=False)
+        return cached_chars
+
+    def _cached_contents(self, method, path, body):
+        if method == "POST":
+            payload = json.loads(body or b"{}")
+            name = f"cachedContents/mock{next(self._ids)}"
+            self.cached_contents[name] = {
+                "name": name,
+                "model": payload.get("model"),
+                "usageMetadata": {"totalTokenCount": count_text_tokens(payload.get("contents", []))},
+            }
+            return "200 OK", self.cached_contents[name], {}
+        name = path[len("/v1beta/"):]
+        if name not in self.cached_contents:
+            return "404 Not Found", {"error": {"message": f"CachedContent not found: {name}"}}, {}
+        if method == "DELETE":
+            del self.cached_contents[name]
+            return "200 OK", {}, {}
+        return "200 OK", self.cached_contents[name], {}
+
+    def _upload(self, path, headers, body):
+        """Two-step resumable upload: `start` returns an upload URL, `upload, finalize` sends the bytes."""
+        command = headers.get("x-goog-upload-command", "")
+        if command == "start":
+            upload_id = next(self._ids)
+            self._uploads[upload_id] = headers.get("x-goog-upload-header-content-type", "application/octet-stream")
+            return "200 OK", {}, {"x-goog-upload-url": f"{self.url}/upload/v1beta/files?upload_id={upload_id}"}
+        if "finalize" in command:
+            upload_id = int(path.rsplit("upload_id=", 1)[-1])
+            mime_type = self._uploads.pop(upload_id)
+            name = f"files/mock{upload_id}"
+            expires = datetime.fromtimestamp(time.time() + 48 * 3600, timezone.utc)
+            self.files[name] = {
+                "name": name,
+                "uri": f"{self.url}/v1beta/{name}",
+                "mimeType": mime_type,
+                "sizeBytes": str(len(body)),
+                "expirationTime": expires.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "state": "ACTIVE",
+            }
+            self._file_data[name] = body
+            return "200 OK", {"file": self.files[name]}, {}
+        return "400 Bad Request", {"error": {"message": f"Unknown upload command: {command}"}}, {}
+
+
+async def serve(**options):
+    async with MockServer(**options) as server:
+        print(f"Mock server listening on {server.url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print(f"Served {server.requests} requests, injected faults: {dict(server.faults)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of a vLLM / Gemini inference server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=8899, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds before the first token")
+    parser.add_argument("--latency-dist", type=str, default="fixed", choices=["fixed", "exponential", "lognormal"],
+                        help="Distribution of the first-token latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Shape of the lognormal latency")
+    parser.add_argument("--output-tokens", type=int, default=2, help="Tokens generated per response")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Generation speed of each response (0: instantaneous)")
+    parser.add_argument("--error-429-rate", type=float, default=0.0, help="Fraction of requests answered 429")
+    parser.add_argument("--error-500-rate", type=float, default=0.0, help="Fraction of requests answered 500")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Fraction of requests held for --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=600.0, help="How long a hanging request is held")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latencies and faults")
+    parser.add_argument("--prefill-per-1k-tokens", type=float, default=0.0,
+                        help="Seconds of simulated prefill per 1000 uncached prompt tokens")
+    parser.add_argument("--prefix-cache-blocks", type=int, default=0,
+                        help="Capacity of the simulated prefix cache in 64-character blocks (0 disables it)")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="Seconds a batch job takes to complete")
+    parser.add_argument("--max-model-len", type=int, default=None,
+                        help="Context window: chat prompts plus max_tokens over it are answered 400, as by vLLM")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(**vars(args)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
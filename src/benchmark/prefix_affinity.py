@@ -0,0 +1,117 @@
+"""
+Benchmark of prefix-aware scheduling against mock vLLM replicas that simulate
+automatic prefix caching (see mock_server.py).
+
+Builds a shuffled prompts file where several queries share each paper's
+task instructions and introduction, then sends it through the vLLM client
+three ways and reports time to first token and the share of prompt tokens
+served from the replicas' prefix caches:
+
+- file order, requests spread by the load balancer only
+- ordered by prefix, no replica affinity
+- ordered by prefix, prefix groups pinned to one replica
+
+Usage:
+python -m src.benchmark.prefix_affinity --papers 40 --queries 8 --replicas 2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+
+from .http_overhead import chat_payload
+from .mock_server import MockServer
+from ..utils.engine import InferenceContext, PendingRequests, ResultWriter
+from ..utils.inference import _run
+
+
+def write_prompts(path, papers, queries, intro_kb, seed=0):
+    instructions = chat_payload(3, seed=seed)["messages"][0]["content"]
+    rows = []
+    for paper in range(papers):
+        intro = chat_payload(intro_kb, seed=seed + 1 + paper)["messages"][0]["content"]
+        for query in range(queries):
+            rows.append({"prompt": f"{instructions}\n\n{intro}\n\nQUERY {paper}-{query}: does gene A regulate gene B?"})
+    random.Random(seed).shuffle(rows)
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+async def run_variant(input_file, results_file, args, order_by_prefix, prefix_affinity):
+    servers = [
+        MockServer(prefill_per_1k_tokens=args.prefill_per_1k_tokens, prefix_cache_blocks=args.cache_blocks)
+        for _ in range(args.replicas)
+    ]
+    for server in servers:
+        await server.__aenter__()
+    try:
+        config = {
+            "model": "mock",
+            "concurrent_requests": args.concurrency,
+            "stream": True,
+            "cache": False,
+            "order_by_prefix": order_by_prefix,
+            "load_balancing": {"prefix_affinity": prefix_affinity, "health_check_interval": 0},
+        }
+        ctx = InferenceContext(config, use_cache=False, endpoints=[server.url for server in servers])
+        writer = ResultWriter(results_file)
+        requests = PendingRequests(
+            input_file, {}, config, writer, order_by_prefix=ctx.order_by_prefix, affinity=ctx.balancer.pins_prefixes
+        )
+        await _run(ctx, "/v1/chat/completions", config, requests, writer)
+        writer.finalize()
+        ctx.close()
+        stats = ctx.stats()
+        prompt_tokens = sum(server.prompt_tokens for server in servers)
+        cached_tokens = sum(server.cached_prompt_tokens for server in servers)
+        return stats, cached_tokens / prompt_tokens
+    finally:
+        for server in servers:
+            await server.__aexit__(None, None, None)
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        input_file = os.path.join(tmp, "prompts.jsonl")
+        write_prompts(input_file, args.papers, args.queries, args.intro_kb)
+        print(
+            f"{args.papers} papers x {args.queries} queries ({args.intro_kb} KB introductions), "
+            f"{args.replicas} replicas, concurrency {args.concurrency}, "
+            f"prefix cache of {args.cache_blocks} blocks per replica"
+        )
+        variants = [
+            ("file order", False, False),
+            ("ordered by prefix", True, False),
+            ("ordered + replica affinity", True, True),
+        ]
+        for name, order_by_prefix, prefix_affinity in variants:
+            results_file = os.path.join(tmp, f"results_{order_by_prefix}_{prefix_affinity}.jsonl")
+            stats, cached_share = await run_variant(input_file, results_file, args, order_by_prefix, prefix_affinity)
+            print(
+                f"  {name:28s} TTFT p50/p90: {stats['ttft_p50'] * 1000:6.1f} / {stats['ttft_p90'] * 1000:6.1f} ms, "
+                f"cached prompt tokens: {cached_share:.0%}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TTFT with and without prefix-aware scheduling on mock replicas.")
+    parser.add_argument("--papers", type=int, default=40, help="Number of distinct papers (shared prefixes)")
+    parser.add_argument("--queries", type=int, default=8, help="Prompts per paper")
+    parser.add_argument("--intro-kb", type=int, default=12, help="Size of each paper introduction in KB")
+    parser.add_argument("--replicas", type=int, default=2, help="Number of mock replicas")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests")
+    parser.add_argument("--cache-blocks", type=int, default=2000,
+                        help="Prefix cache capacity per replica, in 64-character blocks")
+    parser.add_argument("--prefill-per-1k-tokens", type=float, default=0.02,
+                        help="Seconds of simulated prefill per 1000 uncached prompt tokens")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
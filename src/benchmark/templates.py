@@ -44,9 +44,6 @@ Report each instance in the following JSON format. Provide the context of where
 """.strip()
 
 TEMPLATE_SUBPROBLEM_2b = """
-# PAPER EXCERPT:
-{{paper}}
-
 # TASK:
 Analyze the provided scientific paper excerpt. Your task is to act as a scientific editor and identify instances of a specific three-part logical argument structure that authors use to build their case. This structure connects their novel findings to established knowledge to propose a new hypothesis or conclusion.
 
@@ -122,12 +119,15 @@ Provide the analysis **strictly** as a valid JSON array containing objects. Do n
   }
 ]
 ```
-""".strip()
 
-TEMPLATE_SUBPROBLEM_2c = """
+---
+
+Now, analyze the provided scientific paper excerpt following these instructions.
 # PAPER EXCERPT:
 {{paper}}
+""".strip()
 
+TEMPLATE_SUBPROBLEM_2c = """
 # TASK:
 Analyze the provided scientific paper excerpt. Your task is to act as a scientific editor and identify instances of a specific three-part logical argument structure that authors use to build their case. This structure connects their novel findings to established knowledge to propose a new hypothesis or conclusion.
 
@@ -212,6 +212,12 @@ Examples for a list of triplets:
   }
 ]
 ```
+
+---
+
+Now, analyze the provided scientific paper excerpt following these instructions.
+# PAPER EXCERPT:
+{{paper}}
 """
 
 TEMPLATE_MERGED = """
@@ -0,0 +1,176 @@
+"""
+End-to-end throughput benchmark of the inference clients against the local
+mock server, from 1 to 1000 concurrent requests.
+
+For every client and concurrency level, the mock server runs in its own
+process and `run_inference` runs in a fresh worker process over a synthetic
+prompts file, exactly as in a real run (YAML config, results and stats files).
+Reported per level:
+
+- throughput in requests/s, and as a share of the ideal `concurrency / service time`
+- client overhead per request: median latency seen by the client minus the
+  server's service time (first-token latency + generation time); only exact
+  with `--latency-dist fixed`, other distributions have a median below the mean
+- peak RSS of the client process
+
+On a machine with few cores the mock server competes with the client for CPU
+at high concurrency, so overhead there is an upper bound.
+
+Usage:
+python -m src.benchmark.throughput --clients vllm gemini --concurrency 1 10 100 1000 \\
+    --latency 0.2 --output-tokens 64 --tokens-per-second 200
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+MOCK_OPTIONS = (
+    "latency", "latency_dist", "latency_sigma", "output_tokens", "tokens_per_second",
+    "error_429_rate", "error_500_rate", "hang_rate", "hang_seconds", "seed",
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock(args, port):
+    command = [sys.executable, "-m", "src.benchmark.mock_server", "--port", str(port)]
+    for option in MOCK_OPTIONS:
+        value = getattr(args, option)
+        if value is not None:
+            command += [f"--{option.replace('_', '-')}", str(value)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).raise_for_status()
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Mock server did not start")
+
+
+def write_config(path, client, port, concurrency, args):
+    config = {
+        "concurrent_requests": concurrency,
+        "adaptive_concurrency": False,
+        "stream": args.stream,
+        "retry": {"max_attempts": 5, "base_delay": 0.1},
+    }
+    if client == "vllm":
+        config.update({"model": "mock", "hostname": "127.0.0.1", "port": port})
+    else:
+        config.update({"model_name": "mock", "base_url": f"http://127.0.0.1:{port}"})
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+
+
+def write_prompts(path, n, prompt_kb):
+    filler = "word " * (prompt_kb * 1024 // 5)
+    with open(path, "w") as f:
+        for i in range(n):
+            f.write(json.dumps({"prompt": f"Request {i}: {filler}"}) + "\n")
+
+
+def worker(client, config_path, input_file, results_file):
+    """Run one client in this process and print its stats and peak memory as JSON."""
+    # Progress bars and summaries go to stderr/devnull, only the result goes to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    if client == "vllm":
+        from ..utils.inference import run_inference
+        run_inference(config_path, input_file, results_file)
+    else:
+        from ..utils.inference_gemini import run_inference
+        run_inference(config_path, input_file, results_file, "mock")
+    sys.stdout = stdout
+    with open(f"{os.path.splitext(input_file)[0]}_stats.json") as f:
+        stats = json.load(f)
+    stats["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(stats))
+
+
+def run_level(args, client, concurrency, port, tmp):
+    n = args.requests or max(100, 5 * concurrency)
+    name = f"{client}_{concurrency}"
+    config_path = os.path.join(tmp, f"{name}.yaml")
+    input_file = os.path.join(tmp, f"{name}.jsonl")
+    write_config(config_path, client, port, concurrency, args)
+    write_prompts(input_file, n, args.prompt_kb)
+    completed = subprocess.run(
+        [sys.executable, "-m", "src.benchmark.throughput", "--worker", client,
+         config_path, input_file, os.path.join(tmp, f"{name}_results.jsonl")],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True,
+    )
+    return n, json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    service_time = args.latency + (args.output_tokens / args.tokens_per_second if args.tokens_per_second else 0)
+    print(
+        f"Mock service time {service_time * 1000:.0f} ms ({args.latency_dist} first-token latency), "
+        f"{args.prompt_kb} KB prompts, stream={args.stream}"
+    )
+    print(f"{'client':8s} {'conc':>5s} {'requests':>8s} {'req/s':>9s} {'of ideal':>8s} "
+          f"{'overhead':>10s} {'p99':>9s} {'failed':>6s} {'retries':>7s} {'RSS MB':>7s}")
+    port = free_port()
+    server = start_mock(args, port)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for client in args.clients:
+                for concurrency in args.concurrency:
+                    n, stats = run_level(args, client, concurrency, port, tmp)
+                    ideal = concurrency / service_time if service_time else float("inf")
+                    overhead = (stats["latency_p50"] or 0) - service_time
+                    print(
+                        f"{client:8s} {concurrency:5d} {n:8d} {stats['throughput']:9.1f} "
+                        f"{stats['throughput'] / ideal:8.0%} {overhead * 1000:8.1f}ms "
+                        f"{(stats['latency_p99'] or 0) * 1000:7.0f}ms {stats['failed_requests']:6d} "
+                        f"{stats.get('retries', 0):7d} {stats['max_rss_mb']:7.0f}"
+                    )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        worker(*sys.argv[2:6])
+        return
+
+    parser = argparse.ArgumentParser(description="Throughput, per-request overhead and memory of the inference clients.")
+    parser.add_argument("--clients", nargs="+", default=["vllm", "gemini"], choices=["vllm", "gemini"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=None, help="Requests per level (default: max(100, 5 x concurrency))")
+    parser.add_argument("--prompt-kb", type=int, default=4, help="Prompt size in KB")
+    parser.add_argument("--stream", action="store_true", help="Use streaming generation")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean first-token latency of the mock server")
+    parser.add_argument("--latency-dist", type=str, default="fixed", choices=["fixed", "exponential", "lognormal"])
+    parser.add_argument("--latency-sigma", type=float, default=None)
+    parser.add_argument("--output-tokens", type=int, default=16)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--error-429-rate", type=float, default=None)
+    parser.add_argument("--error-500-rate", type=float, default=None)
+    parser.add_argument("--hang-rate", type=float, default=None)
+    parser.add_argument("--hang-seconds", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -120,6 +120,9 @@ def main():
     parser.add_argument("-o", "--output-folder", type=Path, required=True)
     parser.add_argument("-f", "--input-format", type=str, required=True, choices=["pdf", "json"])
     parser.add_argument("--aggregate-only", action='store_true')
+    parser.add_argument("--resume", action='store_true')
+    parser.add_argument("--no-cache", action='store_true')
+    parser.add_argument("--batch", action='store_true')
     args = parser.parse_args()
 
     api_key = os.environ.get("GEMINI_API_KEY")
@@ -156,7 +159,10 @@ def main():
             str(config_path),
             str(prompts_file),
             str(responses_file),
-            api_key=api_key
+            api_key=api_key,
+            resume=args.resume,
+            use_cache=not args.no_cache,
+            batch=args.batch
         )
 
     # 3. Parse results
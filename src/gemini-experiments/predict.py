@@ -19,14 +19,19 @@ import os
 import json
 import argparse
 
-def build_prompt(prefix, input):
+def build_prompt(intro, input):
+    """
+    Build the prompt of a triplet as `(prefix, prompt)`. Together they are the
+    template with `{{main_content}}` replaced by the paper introduction and
+    the query, as before; the prefix (template up to the introduction included)
+    is shared by every query of the same type on the paper, so it can be cached.
+    """
     content_type = input["type"]
     query = input["main_content"]
     template = TEMPLATE_PREDICTION_1 if ("Q1" in content_type) else TEMPLATE_PREDICTION_2
 
-    content = f"{prefix}\n\nQUERY: {query}"
-    prompt = template.replace("{{main_content}}", content)
-    return prompt
+    head, tail = template.split("{{main_content}}", 1)
+    return f"{head}{intro}\n\n", f"QUERY: {query}{tail}"
 
 def build_prompts(paper_path: Path, triplets_file: Path, output_folder: Path):
     """
@@ -59,8 +64,10 @@ def build_prompts(paper_path: Path, triplets_file: Path, output_folder: Path):
     )[0].strip()
     prompts = []
     for triplet in triplets:
-        prompt = build_prompt(prefix, triplet)
+        shared, prompt = build_prompt(prefix, triplet)
         prompts.append({
+            # Identical for every triplet of the paper and type: cached once with `context_cache`
+            "prefix": shared,
             "prompt": prompt,
             **triplet
         })
@@ -131,6 +138,16 @@ def main():
         action="store_true",
         help="Skip prompt building and inference, only aggregate existing results"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only send prompts without a response in the existing responses.jsonl"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the response cache configured in the model YAML"
+    )
     args = parser.parse_args()
 
     api_key = os.environ.get("GEMINI_API_KEY")
@@ -159,7 +176,9 @@ def main():
             str(config_path),
             str(prompts_file),
             str(responses_file),
-            api_key=api_key
+            api_key=api_key,
+            resume=args.resume,
+            use_cache=not args.no_cache
         )
 
     # 3. Aggregate results
@@ -0,0 +1,352 @@
+"""
+Client-side load balancing across several vLLM replicas serving the same model.
+
+`hostname`/`port` in the model YAML may be lists:
+
+    hostname: [34.12.60.86, 35.188.36.133]
+    port: 8881                      # or one port per hostname
+    load_balancing:
+      strategy: least_outstanding   # or "latency"
+      health_check_interval: 30     # seconds between GET /health probes
+      eject_after: 3                # consecutive failures opening a replica's circuit
+      eject_seconds: 60             # then one trial request is let through
+      probe_interval: 5             # seconds between GET /health probes of an open circuit
+      hold: true                    # wait for a replica to recover rather than fail
+      max_hold: 600                 # seconds a request waits at most
+      prefix_affinity: true         # keep requests sharing a prefix on one replica
+      affinity_load_factor: 1.5     # ...unless it is this much busier than average
+
+Each attempt of a request is routed separately, so a retry after a failure
+naturally lands on another replica.
+
+Every replica, even a single one, has a circuit breaker. After `eject_after`
+consecutive connection errors, timeouts or 5xx, or as many failed /health
+checks (every `health_check_interval` with several replicas), its circuit
+opens and no request is sent there. Its /health is then probed every
+`probe_interval` seconds, and one passing probe closes the circuit. After
+`eject_seconds`, one real request is also let through as a trial, for servers
+without /health (a 404 there is not held against them): if the replica
+answers the circuit closes, if it fails or times out the circuit stays open
+for another period.
+While every circuit is open, requests wait in `call` (up to `max_hold`
+seconds) instead of each waiting out its own connection timeout; with
+`hold: false` they fail at once with CircuitOpen.
+"""
+
+import asyncio
+import hashlib
+import time
+
+import httpx
+
+from .retry import classify_error, CircuitOpen
+
+# Error classes that say something about the replica rather than the request,
+# a replica that never answers included
+ENDPOINT_FAILURES = ("connection", "timeout", "deadline", "stalled", "server_error")
+# Error classes of a replica that answered, though not with a response
+ENDPOINT_ANSWERS = ("rate_limited", "client_error", "invalid_response")
+
+
+def make_endpoints(hostname, port):
+    """Expand scalar-or-list `hostname`/`port` config values into base URLs."""
+    hosts = hostname if isinstance(hostname, list) else [hostname]
+    ports = port if isinstance(port, list) else [port] * len(hosts)
+    if len(ports) != len(hosts):
+        raise ValueError(f"Got {len(hosts)} hostnames but {len(ports)} ports")
+    return [f"http://{host}:{p}" for host, p in zip(hosts, ports)]
+
+
+class Endpoint:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.latency = None  # EWMA of successful call latency, seconds
+        self.consecutive_failures = 0
+        self.failed_checks = 0
+        # Circuit breaker: while open, no request is sent until `ejected_until`,
+        # then one trial request at a time
+        self.open = False
+        self.ejected_until = 0.0
+        self.trial = False
+
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.total_latency = 0.0
+        self.successes = 0
+
+    @property
+    def available(self):
+        """Whether a request may be sent: circuit closed, or due for a trial."""
+        return not self.open or (time.monotonic() >= self.ejected_until and not self.trial)
+
+    def stats(self):
+        return {
+            "url": self.base_url,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "mean_latency": self.total_latency / self.successes if self.successes else None,
+        }
+
+
+class LoadBalancer:
+    def __init__(self, base_urls, strategy="least_outstanding", health_check_interval=30,
+                 eject_after=3, eject_seconds=60, prefix_affinity=True, affinity_load_factor=1.5,
+                 probe_interval=5, hold=True, max_hold=600):
+        if strategy not in ("least_outstanding", "latency"):
+            raise ValueError(f"Unknown load balancing strategy: {strategy}")
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self.strategy = strategy
+        self.health_check_interval = health_check_interval
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.probe_interval = probe_interval
+        self.hold = hold
+        self.max_hold = max_hold
+        self.prefix_affinity = prefix_affinity
+        self.affinity_load_factor = affinity_load_factor
+        self._client = None
+        self._health_task = None
+        self._probes = {}
+        # Set and replaced whenever a circuit closes or a trial ends, waking held requests
+        self._changed = asyncio.Event()
+        self.affinity_hits = 0
+        self.affinity_overflows = 0
+        self.held_requests = 0
+        self.hold_seconds = 0.0
+
+    @property
+    def pins_prefixes(self):
+        """Whether requests sharing a prefix are kept on one replica."""
+        return self.prefix_affinity and len(self.endpoints) > 1
+
+    def _score(self, ep):
+        if self.strategy == "latency":
+            # Expected wait: queue ahead of us times typical service time.
+            # Unmeasured replicas get the best known latency so they are tried.
+            known = [e.latency for e in self.endpoints if e.latency is not None]
+            latency = ep.latency if ep.latency is not None else (min(known) if known else 1.0)
+            return (ep.outstanding + 1) * latency
+        return (ep.outstanding, ep.latency or 0.0)
+
+    def pick(self, affinity=None, exclude=()):
+        """
+        Choose a replica for the next attempt, skipping open circuits and
+        those in `exclude` (already running this request) when possible;
+        None if every circuit is open. A replica with a closed circuit is
+        preferred over one due for a trial.
+
+        Requests with the same `affinity` key (a shared prompt prefix) go to the
+        same replica, chosen by rendezvous hashing among the healthy ones, so its
+        prefix cache is reused; when that replica is more than
+        `affinity_load_factor` times busier than average, the request goes to
+        the least loaded one instead.
+        """
+        candidates = [ep for ep in self.endpoints if not ep.open]
+        candidates = candidates or [ep for ep in self.endpoints if ep.available][:1]
+        candidates = [ep for ep in candidates if ep not in exclude] or candidates
+        if not candidates:
+            return None
+        if affinity and self.prefix_affinity and len(candidates) > 1:
+            preferred = max(candidates, key=lambda ep: _rendezvous(affinity, ep.base_url))
+            average = sum(ep.outstanding for ep in candidates) / len(candidates)
+            if preferred.outstanding <= self.affinity_load_factor * average + 1:
+                self.affinity_hits += 1
+                return preferred
+            self.affinity_overflows += 1
+        return min(candidates, key=self._score)
+
+    async def _acquire(self, affinity, exclude):
+        """`pick` a replica, waiting for one to recover while every circuit is open."""
+        ep = self.pick(affinity, exclude)
+        if ep is not None:
+            return ep
+        if not self.hold:
+            raise CircuitOpen("Every replica's circuit is open")
+        self.held_requests += 1
+        start = time.monotonic()
+        try:
+            while ep is None:
+                now = time.monotonic()
+                if self.max_hold is not None and now - start >= self.max_hold:
+                    raise CircuitOpen(f"No replica recovered within {self.max_hold}s")
+                # Woken by a closing circuit or an ended trial, or when the next trial is due
+                timeout = self.max_hold - (now - start) if self.max_hold is not None else None
+                due = [ep.ejected_until - now for ep in self.endpoints if not ep.trial]
+                if due:
+                    timeout = max(min(due), 0.0) if timeout is None else min(timeout, max(min(due), 0.0))
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                ep = self.pick(affinity, exclude)
+            return ep
+        finally:
+            self.hold_seconds += time.monotonic() - start
+
+    async def call(self, path, send, affinity=None, tried=None):
+        """
+        Run `send(url)` against the chosen replica and record the outcome. The
+        replica is appended to `tried`, and replicas already in it are avoided.
+        """
+        ep = await self._acquire(affinity, tried or ())
+        if tried is not None:
+            tried.append(ep)
+        # A request to an open circuit is its trial
+        trial = ep.open
+        ep.trial = ep.trial or trial
+        ep.outstanding += 1
+        ep.requests += 1
+        start = time.monotonic()
+        try:
+            result = await send(ep.base_url + path)
+        except Exception as e:
+            error_class = classify_error(e)
+            if error_class in ENDPOINT_FAILURES:
+                self._on_failure(ep, trial)
+            elif trial and error_class in ENDPOINT_ANSWERS:
+                # The replica answered, the request itself is at fault
+                self._close(ep)
+            raise
+        finally:
+            ep.outstanding -= 1
+            if trial:
+                ep.trial = False
+                self._notify()
+        self._on_success(ep, time.monotonic() - start)
+        return result
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _on_success(self, ep, latency):
+        ep.consecutive_failures = 0
+        ep.successes += 1
+        ep.total_latency += latency
+        ep.latency = latency if ep.latency is None else 0.8 * ep.latency + 0.2 * latency
+        if ep.open:
+            self._close(ep)
+
+    def _on_failure(self, ep, trial=False):
+        ep.failures += 1
+        ep.consecutive_failures += 1
+        # Failures of requests sent before the circuit opened change nothing
+        if trial or (not ep.open and ep.consecutive_failures >= self.eject_after):
+            self._eject(ep)
+
+    def _eject(self, ep):
+        """Open the circuit of `ep` (or keep it open) for `eject_seconds`, probing it meanwhile."""
+        if not ep.open:
+            ep.ejections += 1
+            print(f"\n{ep.base_url} failing, no requests sent there until it recovers")
+        ep.open = True
+        ep.ejected_until = time.monotonic() + self.eject_seconds
+        if self._client and self.probe_interval and ep not in self._probes:
+            self._probes[ep] = asyncio.create_task(self._probe(ep))
+
+    def _close(self, ep):
+        if ep.open:
+            print(f"\n{ep.base_url} recovered")
+        ep.open = False
+        ep.ejected_until = 0.0
+        ep.consecutive_failures = 0
+        ep.failed_checks = 0
+        self._notify()
+
+    async def _healthy(self, ep):
+        """Whether GET /health answers 200, or None if the server has no /health (404)."""
+        try:
+            response = await self._client.get(f"{ep.base_url}/health", timeout=10)
+        except httpx.HTTPError:
+            return False
+        if response.status_code == 404:
+            return None
+        return response.status_code == 200
+
+    async def _probe(self, ep):
+        """Probe an open circuit's replica until it recovers, by probe or trial request."""
+        try:
+            while ep.open:
+                await asyncio.sleep(self.probe_interval)
+                if not ep.open:
+                    break
+                healthy = await self._healthy(ep)
+                if healthy is None:
+                    # Only trial requests can tell
+                    break
+                if healthy:
+                    self._close(ep)
+        finally:
+            self._probes.pop(ep, None)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await asyncio.gather(*(self._check(ep) for ep in self.endpoints))
+
+    async def _check(self, ep):
+        healthy = await self._healthy(ep)
+        if healthy is None:
+            # No /health, requests alone decide
+            return
+        if healthy:
+            # Readmit early, the replica is back
+            ep.failed_checks = 0
+            ep.consecutive_failures = 0
+            if ep.open:
+                self._close(ep)
+            return
+        ep.failed_checks += 1
+        if not ep.open and ep.failed_checks >= self.eject_after:
+            self._eject(ep)
+
+    def start(self, client):
+        """
+        Start background health checks (only worth it with several replicas);
+        `client` also probes ejected replicas.
+        """
+        self._client = client
+        if self.health_check_interval and len(self.endpoints) > 1:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        tasks = list(self._probes.values()) + ([self._health_task] if self._health_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._health_task = None
+        self._probes.clear()
+        self._client = None
+
+    def stats(self):
+        return {
+            "endpoints": [ep.stats() for ep in self.endpoints],
+            "affinity_hits": self.affinity_hits,
+            "affinity_overflows": self.affinity_overflows,
+            "held_requests": self.held_requests,
+            "hold_seconds": self.hold_seconds,
+        }
+
+
+def _rendezvous(key, base_url):
+    return hashlib.sha256(f"{key}|{base_url}".encode("utf-8")).digest()
+
+
+def make_balancer(base_urls, balancing_config=None):
+    """Build a LoadBalancer from the `load_balancing` section of a model YAML."""
+    balancing_config = balancing_config or {}
+    return LoadBalancer(
+        base_urls,
+        strategy=balancing_config.get("strategy", "least_outstanding"),
+        health_check_interval=balancing_config.get("health_check_interval", 30),
+        eject_after=balancing_config.get("eject_after", 3),
+        eject_seconds=balancing_config.get("eject_seconds", 60),
+        prefix_affinity=balancing_config.get("prefix_affinity", True),
+        affinity_load_factor=balancing_config.get("affinity_load_factor", 1.5),
+        probe_interval=balancing_config.get("probe_interval", 5),
+        hold=balancing_config.get("hold", True),
+        max_hold=balancing_config.get("max_hold", 600),
+    )
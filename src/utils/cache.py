@@ -0,0 +1,226 @@
+"""
+Persistent, content-addressed cache of raw LLM responses.
+
+Keys are SHA-256 hashes of everything that determines a response (endpoint or
+model, the full payload including generationConfig, and the digest of any
+attached file), values are the raw response JSON. Entries are stored in a
+single SQLite file and evicted by age and by total size (least recently used
+first).
+
+Enable it from the model YAML:
+
+    cache:
+      path: .cache/llm_responses.sqlite
+      max_age_days: 30
+      max_size_mb: 1024
+
+`EncodedFileCache` is the in-memory counterpart for request attachments: it
+keeps base64-encoded files so a PDF sent with several templates or models is
+read and encoded once per run.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_PATH = ".cache/llm_responses.sqlite"
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    """SHA-256 of a file's content, read in chunks."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_cache_key(*parts):
+    """Hash any JSON-serialisable parts into a cache key."""
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age_days=None, max_size_mb=None, bypass=False):
+        """
+        :param path: SQLite file, created if missing.
+        :param max_age_days: Entries older than this are never served and get evicted.
+        :param max_size_mb: Total size of stored responses; least recently used
+            entries are evicted above it.
+        :param bypass: Skip lookups but still store fresh responses, e.g. to
+            draw new samples and refresh the cache.
+        """
+        self.path = path
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.max_size = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        # All calls happen on the event loop thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._db.commit()
+        self.evict()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None."""
+        if self.bypass:
+            self.misses += 1
+            return None
+        row = self._db.execute(
+            "SELECT value, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or (self.max_age and now - row[1] > self.max_age):
+            self.misses += 1
+            return None
+        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        blob = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created, accessed)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, blob, len(blob), now, now)
+        )
+        self._db.commit()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under the size budget."""
+        if self.max_age:
+            self._db.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+            )
+        if self.max_size:
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_size:
+                rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed ASC")
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self._db.commit()
+
+    def close(self):
+        self.evict()
+        self._db.close()
+
+    def stats(self):
+        return {"cache_hits": self.hits, "cache_misses": self.misses}
+
+
+def open_cache(cache_config, bypass=False):
+    """Build a ResponseCache from the `cache` section of a model YAML, or None if absent."""
+    if not cache_config:
+        return None
+    if cache_config is True:
+        cache_config = {}
+    return ResponseCache(
+        path=cache_config.get("path", DEFAULT_CACHE_PATH),
+        max_age_days=cache_config.get("max_age_days"),
+        max_size_mb=cache_config.get("max_size_mb"),
+        bypass=bypass or cache_config.get("bypass", False),
+    )
+
+
+def _read_and_encode(file_path):
+    """Digest and base64 bytes of a file from a single read."""
+    with open(file_path, "rb") as f:
+        raw = f.read()
+    return hashlib.sha256(raw).hexdigest(), base64.b64encode(raw)
+
+
+class EncodedFileCache:
+    """
+    LRU of base64-encoded attachments, keyed by file digest, within a byte budget.
+
+    Digests are remembered per (path, mtime, size), so an unchanged file is
+    neither re-read nor re-hashed, and an edited one is picked up. Encoded data
+    is kept as ASCII bytes, to be spliced into request bodies without further
+    copies (see `engine.Blob`). Concurrent requests for the same file share a
+    single read.
+    """
+
+    def __init__(self, max_mb=512):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    @staticmethod
+    def _stat_key(file_path):
+        st = os.stat(file_path)
+        return os.path.abspath(file_path), st.st_mtime_ns, st.st_size
+
+    async def digest(self, file_path):
+        """SHA-256 of the file, computed once per version of the file."""
+        key = self._stat_key(file_path)
+        if key not in self._digests:
+            self._digests[key] = await asyncio.to_thread(file_digest, file_path)
+        return self._digests[key]
+
+    async def encode(self, file_path):
+        """Return `(digest, base64 bytes)` of the file, from memory when possible."""
+        key = self._stat_key(file_path)
+        digest = self._digests.get(key)
+        if digest in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(digest)
+            return digest, self._entries[digest]
+
+        if key in self._loading:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._loading[key] = asyncio.ensure_future(self._load(file_path, key))
+        # Shielded so a cancelled request does not cancel the read for the others
+        return await asyncio.shield(self._loading[key])
+
+    async def _load(self, file_path, key):
+        try:
+            digest, data = await asyncio.to_thread(_read_and_encode, file_path)
+        finally:
+            del self._loading[key]
+        self._digests[key] = digest
+        if len(data) <= self.max_bytes and digest not in self._entries:
+            self._entries[digest] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        return digest, data
+
+    def stats(self):
+        return {
+            "file_cache_hits": self.hits,
+            "file_cache_misses": self.misses,
+            "file_cache_bytes": self.size,
+        }
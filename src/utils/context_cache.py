@@ -0,0 +1,141 @@
+"""
+Gemini context caching for prompt prefixes shared by many requests.
+
+Rows of a prompts file may carry a `prefix` next to their `prompt`; the text
+sent to the model is `prefix + prompt`. The prediction pipelines, for
+instance, put the paper introduction in `prefix` and the triplet query in
+`prompt`. With context caching enabled, each distinct prefix is stored once as
+a `cachedContents` entry and every request only sends its own suffix, so the
+model does not re-process the same introduction for every query and the cached
+tokens are billed at the reduced rate.
+
+Enable it from the Gemini model YAML:
+
+    context_cache:
+      ttl: 3600          # seconds a cache entry lives
+      min_tokens: 1024   # smaller prefixes are sent inline (the API minimum depends on the model)
+      keep: false        # delete the entries at the end of the run
+"""
+
+import asyncio
+import hashlib
+
+from .engine import check_status, with_retries
+from .retry import classify_error, RETRYABLE_CLASSES
+from .limits import CHARS_PER_TOKEN
+
+
+class ContextCaches:
+    def __init__(self, ctx, base_url, api_key, model_name, ttl=3600, min_tokens=1024, keep=False):
+        """
+        :param ctx: The run's `engine.InferenceContext`, for its client and retry policy.
+        """
+        self.ctx = ctx
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model_name = model_name
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.keep = keep
+
+        # Prefix digest -> cache name, or None if the prefix cannot be cached
+        self._names = {}
+        self._creating = {}
+        self._created = []
+
+        self.created = 0
+        self.hits = 0
+        self.failures = 0
+
+    @staticmethod
+    def _digest(prefix):
+        return hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    async def get(self, prefix):
+        """Name of the cache entry holding `prefix`, creating it on first use, or None to send it inline."""
+        if len(prefix) // CHARS_PER_TOKEN < self.min_tokens:
+            return None
+        digest = self._digest(prefix)
+        if digest not in self._names:
+            if digest not in self._creating:
+                self._creating[digest] = asyncio.ensure_future(self._create(digest, prefix))
+            await asyncio.shield(self._creating[digest])
+        name = self._names[digest]
+        if name:
+            self.hits += 1
+        return name
+
+    def invalidate(self, prefix, name):
+        """Forget an entry the API no longer knows (expired or deleted), so it is created again."""
+        digest = self._digest(prefix)
+        if self._names.get(digest) == name:
+            del self._names[digest]
+            self._created.remove(name)
+
+    async def _create(self, digest, prefix):
+        body = {
+            "model": f"models/{self.model_name}",
+            "contents": [{"role": "user", "parts": [{"text": prefix}]}],
+            "ttl": f"{self.ttl}s",
+            "displayName": f"prefix-{digest[:12]}",
+        }
+
+        async def attempt_once(timeout, per_attempt):
+            response = await self.ctx.client.post(
+                f"{self.base_url}/v1beta/cachedContents",
+                headers={"x-goog-api-key": self.api_key, "Content-Type": "application/json"},
+                json=body,
+            )
+            check_status(response, None)
+            return response.json()
+
+        try:
+            entry = await with_retries(attempt_once, self.ctx.retry, None, 0)
+            self._names[digest] = entry["name"]
+            self._created.append(entry["name"])
+            self.created += 1
+        except Exception as e:
+            if classify_error(e) in RETRYABLE_CLASSES:
+                raise
+            # E.g. below the model's minimum cacheable size: fall back to sending it inline
+            print(f"Context cache not created, prefix sent inline: {e}")
+            self.failures += 1
+            self._names[digest] = None
+        finally:
+            del self._creating[digest]
+
+    async def close(self):
+        """Delete the entries created during this run, unless `keep` is set."""
+        if self.keep:
+            return
+        for name in self._created:
+            try:
+                response = await self.ctx.client.delete(
+                    f"{self.base_url}/v1beta/{name}", headers={"x-goog-api-key": self.api_key}
+                )
+                check_status(response, None)
+            except Exception as e:
+                # The entry expires with its TTL anyway
+                print(f"Could not delete context cache {name}: {e}")
+        self._created = []
+
+    def stats(self):
+        return {
+            "context_caches_created": self.created,
+            "context_cache_requests": self.hits,
+            "context_cache_failures": self.failures,
+        }
+
+
+def make_context_caches(ctx, base_url, api_key, model_name, cache_config=None):
+    """Build ContextCaches from the `context_cache` section of a Gemini YAML, or None if absent."""
+    if not cache_config:
+        return None
+    if cache_config is True:
+        cache_config = {}
+    return ContextCaches(
+        ctx, base_url, api_key, model_name,
+        ttl=cache_config.get("ttl", 3600),
+        min_tokens=cache_config.get("min_tokens", 1024),
+        keep=cache_config.get("keep", False),
+    )
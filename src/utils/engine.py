@@ -0,0 +1,1067 @@
+"""
+Asyncio dispatch loop shared by the vLLM (`inference.py`) and Gemini
+(`inference_gemini.py`) clients.
+
+Each client provides a coroutine `send(data, request_id)` returning the usual
+`(request_id, result_entry, error_entry)` triple; this module takes care of the
+HTTP connection pool, the bounded in-flight window and the bookkeeping around it.
+"""
+
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+from collections import Counter
+import httpx
+from tqdm import tqdm
+from .retry import (
+    RequestError, DeadlineExceeded, AttemptTimeout, StreamStalled, parse_retry_after, make_retry_policy
+)
+from .limits import make_limiter, make_rate_limiter
+from .cache import open_cache
+from .balancer import make_balancer
+from .telemetry import Telemetry
+from .schedule import CostSchedule
+from .hedging import make_hedger
+from .sampling import make_aggregator
+
+
+def iter_prompts(input_file):
+    """Yield the prompts of a JSONL file one at a time, skipping empty lines."""
+    with open(input_file, "r") as f:
+        for line in f:
+            if line.strip():  # Skip empty lines
+                yield json.loads(line)
+
+
+def count_prompts(input_file):
+    """Number of non-empty lines, without parsing them."""
+    with open(input_file, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def request_key(data, config):
+    """
+    Stable identity of a request: a hash of the prompt, the attached file and the
+    model/generation config. Unlike the positional request_id it survives
+    reordering or rebuilding of the prompts file.
+    """
+    parts = [data.get("prompt"), data.get("file_path"), config]
+    if data.get("prefix"):
+        # Only rows with a shared prefix hash it, older keys stay valid
+        parts.append(data["prefix"])
+    blob = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def numbered_keys(config):
+    """
+    Function giving rows, passed in file order, their `(request_key, n)`: n
+    counts the earlier rows with the same key, so that repeated rows, which are
+    independent samples, keep apart.
+    """
+    seen = Counter()
+
+    def key(data):
+        k = request_key(data, config)
+        n = seen[k]
+        seen[k] += 1
+        return k, n
+
+    return key
+
+
+def full_prompt(data):
+    """The text the model sees for a row: its shared `prefix` (if any) followed by its `prompt`."""
+    return (data.get("prefix") or "") + (data.get("prompt") or "")
+
+
+PREFIX_BLOCK_CHARS = 2048
+PREFIX_KEY_BLOCKS = 16
+
+
+def prefix_sort_key(text):
+    """
+    Sort key that places prompts sharing long prefixes next to each other.
+
+    The text is hashed cumulatively in blocks of PREFIX_BLOCK_CHARS characters
+    (block k's hash covers blocks 0..k), so sorting by the concatenated hashes
+    groups prompts by their longest common block prefix, like walking a trie,
+    while only keeping ~130 bytes per prompt.
+    """
+    h = hashlib.sha256()
+    key = bytearray()
+    for start in range(0, min(len(text), PREFIX_BLOCK_CHARS * PREFIX_KEY_BLOCKS), PREFIX_BLOCK_CHARS):
+        h.update(text[start:start + PREFIX_BLOCK_CHARS].encode("utf-8"))
+        key += h.copy().digest()[:8]
+    return bytes(key)
+
+
+def _common_blocks(key, other):
+    """Number of leading blocks two `prefix_sort_key`s have in common."""
+    n = 0
+    while n * 8 < min(len(key), len(other)) and key[n * 8:n * 8 + 8] == other[n * 8:n * 8 + 8]:
+        n += 1
+    return n
+
+
+def affinity_key(data, requests=None, request_id=None):
+    """
+    Identity of a row's prefix group, for pinning the group to one replica:
+    the group found by `PendingRequests` when it orders by prefix, else the
+    row's explicit `prefix`, else None.
+    """
+    if requests is not None:
+        group = requests.affinity.pop(request_id, None)
+        if group:
+            return group
+    if data.get("prefix"):
+        return hashlib.sha256(data["prefix"].encode("utf-8")).hexdigest()
+    return None
+
+
+def load_answered(results_file, config):
+    """
+    Locate rows with a non-null response from a previous run, keyed by
+    `(request_key, n)` as given by `numbered_keys`: the n-th of repeated rows,
+    by request id, only reuses the answer of the n-th one of the previous run.
+
+    Both the ordered results file and the `.partial` file of an interrupted run
+    are read; the partial file wins since it is the most recent. Only the
+    `(path, byte offset)` of each row is kept, not the row itself.
+    """
+    # Request id -> request key, and location if answered
+    rows = {}
+    for path in (results_file, f"{results_file}.partial"):
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            offset = f.tell()
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    row = {}  # Torn last line of an interrupted write
+                if "request_id" in row:
+                    located = (path, offset) if row.get("response") is not None else None
+                    if located or row["request_id"] not in rows:
+                        rows[row["request_id"]] = (request_key(row, config), located)
+                offset += len(line)
+    answered = {}
+    seen = Counter()
+    for request_id in sorted(rows):
+        key, located = rows[request_id]
+        if located:
+            answered[(key, seen[key])] = located
+        seen[key] += 1
+    return answered
+
+
+class PendingRequests:
+    """
+    Lazily yields the `(request_id, data)` pairs of `input_file` that still
+    need to be dispatched. Already-answered rows are copied to `writer` as
+    they are reached instead. Rows are read one at a time, so memory does not
+    grow with the size of the prompts.
+
+    With `order_by_prefix`, rows are dispatched in `prefix_sort_key` order
+    so that requests sharing a prefix (paper introduction, task instructions)
+    run back to back and hit the server's prefix cache. This costs one extra
+    pass over the file and a small key per row; request ids, and so the order
+    of the results file, are unchanged. With `affinity` (a balancer pinning
+    prefixes to replicas), the prefix a pending row shares with its neighbours
+    identifies its group in `affinity` (request id -> key) until `affinity_key`
+    consumes it or `dispatch` writes the row.
+
+    With a `schedule` (`schedule.CostSchedule`), rows are also ordered by
+    estimated cost, most expensive first by default. Rows of a prefix group
+    stay together, and groups are ordered by their most expensive row. The
+    schedule records the cost of every dispatched row.
+    """
+
+    def __init__(self, input_file, answered, config, writer, order_by_prefix=False, schedule=None, affinity=False):
+        self.input_file = input_file
+        self.answered = answered
+        self.config = config
+        self.writer = writer
+        self.order_by_prefix = order_by_prefix
+        self.schedule = schedule
+        self.total = count_prompts(input_file)
+        self.resumed = 0
+        self.record_affinity = affinity
+        self.affinity = {}
+
+    def _rows(self):
+        """
+        Yield `(request_id, data, group, cost)`, `group` being None unless
+        ordering by prefix and `cost` None without a schedule.
+        """
+        schedule = self.schedule
+        if not self.order_by_prefix and not (schedule and schedule.ordered):
+            for i, data in enumerate(iter_prompts(self.input_file)):
+                yield i, data, None, schedule.cost(data) if schedule else None
+            return
+        keys = []
+        with open(self.input_file, "rb") as f:
+            offset = 0
+            i = 0
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    key = prefix_sort_key(full_prompt(data)) if self.order_by_prefix else b""
+                    keys.append((key, i, offset, schedule.cost(data) if schedule else None))
+                    i += 1
+                offset += len(line)
+            keys.sort(key=lambda row: row[:2])
+
+            # Consecutive rows of the same group form one unit of the schedule
+            units = []
+            for j, (key, i, offset, cost) in enumerate(keys):
+                # The longest prefix shared with a neighbour defines the group
+                depth = max(
+                    _common_blocks(key, keys[j - 1][0]) if j > 0 else 0,
+                    _common_blocks(key, keys[j + 1][0]) if j + 1 < len(keys) else 0,
+                )
+                group = key[:depth * 8].hex() if depth else None
+                if group and units and units[-1][0] == group:
+                    units[-1][1].append(j)
+                else:
+                    units.append((group, [j]))
+            if schedule and schedule.ordered:
+                # Stable: groups tied on cost keep their prefix order
+                units.sort(key=lambda unit: schedule.sort_key(max(keys[j][3] for j in unit[1])))
+
+            for group, rows in units:
+                for j in rows:
+                    key, i, offset, cost = keys[j]
+                    f.seek(offset)
+                    yield i, json.loads(f.readline()), group, cost
+
+    def __iter__(self):
+        # A results file and its .partial at most
+        previous = {}
+        # Repeated rows have the same sort key and cost, so they come in file order
+        key = numbered_keys(self.config) if self.answered else None
+        try:
+            for i, data, group, cost in self._rows():
+                found = self.answered.get(key(data)) if key else None
+                if found is None:
+                    if group and self.record_affinity:
+                        self.affinity[i] = group
+                    if self.schedule:
+                        self.schedule.dispatched(i, cost)
+                    yield i, data
+                    continue
+                path, offset = found
+                if path not in previous:
+                    previous[path] = open(path, "rb")
+                previous[path].seek(offset)
+                row = json.loads(previous[path].readline())
+                self.writer.write(i, {**row, **data, "request_id": i})
+                self.resumed += 1
+        finally:
+            for f in previous.values():
+                f.close()
+
+
+# httpcore scans every connection of a pool for every waiting request on each
+# pool event, so a single pool of hundreds of connections spends most of the
+# client's CPU there; pools of a few connections keep that scan short
+POOL_SHARD_CONNECTIONS = 8
+
+
+class ShardedClient:
+    """
+    Several AsyncClients sharing the connections of a run, used like a single
+    one. Each request goes to the shard with the fewest requests in progress.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self._active = [0] * len(clients)
+
+    def _pick(self):
+        return min(range(len(self.clients)), key=self._active.__getitem__)
+
+    async def request(self, method, url, **kwargs):
+        shard = self._pick()
+        self._active[shard] += 1
+        try:
+            return await self.clients[shard].request(method, url, **kwargs)
+        finally:
+            self._active[shard] -= 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        shard = self._pick()
+        self._active[shard] += 1
+        try:
+            async with self.clients[shard].stream(method, url, **kwargs) as response:
+                yield response
+        finally:
+            self._active[shard] -= 1
+
+    async def __aenter__(self):
+        for client in self.clients:
+            await client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        for client in self.clients:
+            await client.__aexit__(*exc)
+
+
+# Seconds to open a connection, and to wait for the next bytes of a response
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 900
+
+
+def make_timeouts(timeout_config=None):
+    """
+    `(httpx.Timeout, total)` from the `timeout` section of a model YAML:
+    seconds for every phase, or `connect`, `read` and `total` (seconds per
+    attempt, no limit by default) separately.
+    """
+    if timeout_config is None:
+        timeout_config = {}
+    if not isinstance(timeout_config, dict):
+        return httpx.Timeout(timeout_config), timeout_config
+    timeout = httpx.Timeout(
+        timeout_config.get("read", READ_TIMEOUT), connect=timeout_config.get("connect", CONNECT_TIMEOUT)
+    )
+    return timeout, timeout_config.get("total")
+
+
+def make_client(concurrent_requests, timeout=READ_TIMEOUT, headers=None, http2=False, keepalive_expiry=60):
+    """
+    Create the HTTP client of a run, with connection pools sized to the in-flight window.
+
+    Connections are kept alive between requests, so only the first requests of
+    a run pay for the TCP and TLS handshakes. Above POOL_SHARD_CONNECTIONS
+    connections the pool is split over several AsyncClients (`ShardedClient`).
+    `http2` multiplexes requests over fewer connections and needs the optional
+    `h2` package (`httpx[http2]`).
+    """
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("HTTP/2 needs the h2 package (uv pip install 'httpx[http2]'), falling back to HTTP/1.1")
+            http2 = False
+
+    shards = -(-concurrent_requests // POOL_SHARD_CONNECTIONS)
+    connections = -(-concurrent_requests // shards)
+    limits = httpx.Limits(
+        max_connections=connections,
+        max_keepalive_connections=connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    clients = [
+        httpx.AsyncClient(limits=limits, timeout=timeout, headers=headers, http2=http2)
+        for _ in range(shards)
+    ]
+    return clients[0] if shards == 1 else ShardedClient(clients)
+
+
+class Blob:
+    """
+    Pre-encoded ASCII bytes (e.g. base64 file data) standing in for a JSON
+    string in a payload. `encode_body` splices them into the body as-is, so
+    large attachments are not copied into intermediate `str` objects.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+_BLOB_MARKER = re.compile(rb'"\\u0000blob(\d+)\\u0000"')
+
+
+def encode_body(payload, headers=None, gzip_min_bytes=None):
+    """
+    Serialize `payload` to JSON once, gzip-compressed if it is at least
+    `gzip_min_bytes` long. Returns the body and the headers to send with it.
+    """
+    blobs = []
+
+    def placeholder(obj):
+        if not isinstance(obj, Blob):
+            raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+        blobs.append(obj.data)
+        return f"\x00blob{len(blobs) - 1}\x00"
+
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=placeholder).encode("utf-8")
+    if blobs:
+        # Join the JSON around the placeholders with the blobs: one copy of each
+        chunks = []
+        for i, piece in enumerate(_BLOB_MARKER.split(body)):
+            chunks.extend((b'"', blobs[int(piece)], b'"') if i % 2 else (piece,))
+        body = b"".join(chunks)
+    headers = {**(headers or {}), "Content-Type": "application/json"}
+    if gzip_min_bytes is not None and len(body) >= gzip_min_bytes:
+        # Level 1 already shrinks prose ~3x at ~1 ms per 100 KB, higher levels cost far more CPU
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def describe_error(e):
+    """httpx timeouts often carry an empty message, fall back to the class name."""
+    return str(e) or e.__class__.__name__
+
+
+# Statuses meaning "slow down" rather than "this request is wrong"
+OVERLOAD_STATUSES = (429, 503)
+
+
+def check_status(response, limiter):
+    """Raise RequestError for non-200 responses, reporting overload to `limiter`."""
+    if response.status_code == 200:
+        return
+    if limiter and response.status_code in OVERLOAD_STATUSES:
+        limiter.on_overload()
+    try:
+        error = response.json().get("error", {})
+        err_msg = error.get("message", response.text) if isinstance(error, dict) else str(error)
+    except Exception:
+        err_msg = response.text
+    raise RequestError(response.status_code, err_msg, parse_retry_after(response))
+
+
+def _timeout_error(timeout, per_attempt, limiter):
+    """
+    The error for an attempt cut short after `timeout` seconds: AttemptTimeout,
+    an overload signal like other timeouts, when the per-attempt limit fired,
+    DeadlineExceeded when the per-request deadline did.
+    """
+    if not per_attempt:
+        return DeadlineExceeded("Per-request deadline exceeded")
+    if limiter:
+        limiter.on_overload()
+    return AttemptTimeout(f"No complete response within {timeout}s")
+
+
+async def _post_once(client, url, body, headers, limiter, timeout, per_attempt=False):
+    start = time.monotonic()
+    try:
+        post = client.post(url, headers=headers, content=body)
+        response = await (post if timeout is None else asyncio.wait_for(post, timeout))
+    except asyncio.TimeoutError:
+        raise _timeout_error(timeout, per_attempt, limiter)
+    except httpx.TimeoutException:
+        if limiter:
+            limiter.on_overload()
+        raise
+
+    check_status(response, limiter)
+
+    if limiter:
+        limiter.on_success(time.monotonic() - start)
+    return response.json()
+
+
+async def _stream_once(client, url, body, headers, limiter, timeout, merge, idle_timeout, per_attempt=False):
+    start = time.monotonic()
+    events = []
+    event_times = []
+
+    async def consume():
+        async with client.stream("POST", url, headers=headers, content=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                check_status(response, limiter)
+            lines = response.aiter_lines()
+            while True:
+                # The first event may wait for queueing and prefill, later ones
+                # must keep coming or the generation is considered stuck
+                try:
+                    if event_times and idle_timeout:
+                        line = await asyncio.wait_for(anext(lines), idle_timeout)
+                    else:
+                        line = await anext(lines)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise StreamStalled(f"No stream event for {idle_timeout}s, aborted")
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                events.append(json.loads(data))
+                event_times.append(time.monotonic())
+
+    try:
+        await (consume() if timeout is None else asyncio.wait_for(consume(), timeout))
+    except asyncio.TimeoutError:
+        raise _timeout_error(timeout, per_attempt, limiter)
+    except (httpx.TimeoutException, StreamStalled):
+        if limiter:
+            limiter.on_overload()
+        raise
+
+    if limiter:
+        limiter.on_success(time.monotonic() - start)
+
+    timing = {
+        "ttft": event_times[0] - start if event_times else None,
+        "inter_token_latency": (
+            (event_times[-1] - event_times[0]) / (len(event_times) - 1)
+            if len(event_times) > 1 else None
+        ),
+        "stream_events": len(events),
+    }
+    return merge(events), timing
+
+
+async def with_retries(attempt_once, retry, rate_limiter, cost, attempt_timeout=None):
+    """
+    Call `attempt_once(timeout, per_attempt)` until it succeeds or `retry`
+    gives up. Every attempt first takes one request and `cost` tokens from
+    `rate_limiter`. `timeout` is the time left before the retry deadline, or
+    `attempt_timeout` if that is shorter, which `per_attempt` tells: running
+    out of it should then raise AttemptTimeout, which is retried, rather than
+    DeadlineExceeded.
+    """
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        elapsed = time.monotonic() - start
+        remaining = retry.remaining(elapsed) if retry else None
+        timeout = remaining
+        per_attempt = attempt_timeout is not None and (remaining is None or attempt_timeout < remaining)
+        if per_attempt:
+            timeout = attempt_timeout
+        if rate_limiter:
+            await rate_limiter.acquire(cost)
+        try:
+            return await attempt_once(timeout, per_attempt)
+        except Exception as e:
+            if retry is None:
+                raise e
+            delay = retry.next_delay(attempt, e, time.monotonic() - start)
+            if delay is None:
+                raise e
+        await asyncio.sleep(delay)
+
+
+def _hedged(attempt, hedger, limiter=None, rate_limiter=None, cost=0):
+    """
+    `attempt(tried)` run through `hedger` (see `hedging.Hedger`), or once
+    without one. A hedge takes its own request and `cost` tokens from
+    `rate_limiter`, and is held back while `limiter` is backing off.
+    """
+    if not hedger:
+        return attempt(None)
+    admit = (lambda: rate_limiter.acquire(cost)) if rate_limiter else None
+    return hedger.run(attempt, admit=admit, limiter=limiter)
+
+
+async def post_json(client, url, payload, headers=None, limiter=None, retry=None,
+                    rate_limiter=None, cost=0, balancer=None, gzip_min_bytes=None, affinity=None,
+                    hedger=None, attempt_timeout=None):
+    """
+    POST a JSON payload and return the decoded response.
+
+    Transient failures are retried according to `retry` (see `retry.RetryPolicy`).
+    Overload signals (429/503, timeouts) and the latency of successful calls
+    are reported to `limiter` so it can adapt the in-flight window. Every
+    attempt first takes one request and `cost` tokens from `rate_limiter`, and
+    is abandoned after `attempt_timeout` seconds. With a `balancer`, `url` is a path and each attempt is routed to one of
+    its replicas, preferably the one pinned to `affinity` (see
+    `balancer.LoadBalancer.pick`). A slow attempt is duplicated by `hedger`,
+    if any, within the same limits. The body is serialized (and compressed, see `encode_body`) once
+    and reused by every attempt.
+    """
+    body, headers = encode_body(payload, headers, gzip_min_bytes)
+
+    async def attempt_once(timeout, per_attempt):
+        async def send(target):
+            return await _post_once(client, target, body, headers, limiter, timeout, per_attempt)
+
+        async def route(tried):
+            return await (balancer.call(url, send, affinity, tried) if balancer else send(url))
+        return await _hedged(route, hedger, limiter, rate_limiter, cost)
+    return await with_retries(attempt_once, retry, rate_limiter, cost, attempt_timeout)
+
+
+async def post_sse(client, url, payload, merge, headers=None, limiter=None, retry=None,
+                   rate_limiter=None, cost=0, idle_timeout=None, balancer=None, gzip_min_bytes=None,
+                   affinity=None, hedger=None, attempt_timeout=None):
+    """
+    POST a streaming request and read its server-sent events.
+
+    `merge(events)` assembles the decoded `data:` events into the same shape as
+    the non-streaming response. Returns `(response_json, timing)` where timing
+    holds the time to first token, the mean inter-token latency and the event
+    count. A stream that goes quiet for `idle_timeout` seconds after its first
+    event is aborted (and retried like a timeout). Retries, limiters,
+    balancer, hedging and compression behave as in `post_json`.
+    """
+    body, headers = encode_body(payload, headers, gzip_min_bytes)
+
+    async def attempt_once(timeout, per_attempt):
+        async def send(target):
+            return await _stream_once(
+                client, target, body, headers, limiter, timeout, merge, idle_timeout, per_attempt
+            )
+
+        async def route(tried):
+            return await (balancer.call(url, send, affinity, tried) if balancer else send(url))
+        return await _hedged(route, hedger, limiter, rate_limiter, cost)
+    return await with_retries(attempt_once, retry, rate_limiter, cost, attempt_timeout)
+
+
+class InferenceContext:
+    """
+    Per-run machinery shared by every request of a run: the pooled HTTP client
+    plus the concurrency limiter, retry policy, rate limiter, response cache,
+    streaming options, dispatch order, replica balancer and request hedging
+    configured in the model YAML.
+    """
+
+    def __init__(self, config, use_cache=True, endpoints=None):
+        """
+        Pop the engine settings from `config`; what remains is the model's own config.
+
+        :param endpoints: Base URLs of the replicas serving the model. When
+            given, request URLs are paths routed by a `balancer.LoadBalancer`.
+        """
+        # Ceiling of the adaptive in-flight window and size of the connection pool
+        self.concurrent_requests = config.pop("concurrent_requests", 10)
+        self.limiter = make_limiter(self.concurrent_requests, config.pop("adaptive_concurrency", None))
+        self.retry = make_retry_policy(config.pop("retry", None))
+        # Per-key quotas: requests and input tokens per minute
+        self.rate_limiter = make_rate_limiter(config.pop("rpm", None), config.pop("tpm", None))
+        # Optional persistent response cache, `use_cache=False` bypasses lookups
+        self.cache = open_cache(config.pop("cache", None), bypass=not use_cache)
+        # Server-sent events instead of one blocking response
+        self.stream = config.pop("stream", False)
+        self.idle_timeout = config.pop("stream_idle_timeout", None)
+        # Dispatch requests sharing a prefix back to back
+        self.order_by_prefix = config.pop("order_by_prefix", True)
+        # Dispatch order by estimated cost, see `schedule`
+        self.schedule_order = config.pop("schedule", "longest_first")
+        self.cost_schedule = None
+        # Completions per request and how they are reduced to one, see sampling.py
+        self.samples_per_prompt = config.pop("samples_per_prompt", 1)
+        self.aggregate = make_aggregator(config.pop("sample_aggregation", "first"))
+        # Send identical requests once per run, see `deduplicate`. Repeated rows
+        # are independent samples unless decoding is greedy, so by default only
+        # then; `temperature` is left in the config for the model
+        self.dedup = config.pop("dedup", None)
+        if self.dedup is None:
+            self.dedup = config.get("temperature") == 0 and self.samples_per_prompt == 1
+        self.deduplicator = None
+        self.balancer = make_balancer(endpoints, config.pop("load_balancing", None)) if endpoints else None
+        # Duplicates of straggling attempts
+        self.hedger = make_hedger(config.pop("hedge", None), self.concurrent_requests)
+        self.telemetry = Telemetry()
+        # Connection reuse, HTTP/2 and request compression
+        http_config = config.pop("http", None) or {}
+        self.http2 = http_config.get("http2", False)
+        self.keepalive_expiry = http_config.get("keepalive_expiry", 60)
+        self.gzip_min_bytes = http_config.get("gzip_min_bytes", 16384) if http_config.get("gzip") else None
+        # Connect/read timeouts of the client and total seconds per attempt
+        self.timeout, self.attempt_timeout = make_timeouts(config.pop("timeout", None))
+        # Wall-clock budget of the whole run, see `RunDeadline`
+        run_deadline = config.pop("run_deadline", None)
+        self.deadline = RunDeadline(run_deadline) if run_deadline else None
+        self.client = None
+
+    async def __aenter__(self):
+        # Hedges run on top of the in-flight window
+        connections = self.concurrent_requests + (self.hedger.max_in_flight if self.hedger else 0)
+        self.client = make_client(
+            connections, timeout=self.timeout, http2=self.http2, keepalive_expiry=self.keepalive_expiry
+        )
+        await self.client.__aenter__()
+        if self.balancer:
+            self.balancer.start(self.client)
+        self.telemetry.start()
+        if self.deadline:
+            self.deadline.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.telemetry.stop()
+        if self.balancer:
+            await self.balancer.stop()
+        await self.client.__aexit__(*exc)
+        self.client = None
+
+    async def post(self, url, payload, headers=None, cost=0, affinity=None):
+        return await post_json(
+            self.client, url, payload, headers=headers, limiter=self.limiter,
+            retry=self.retry, rate_limiter=self.rate_limiter, cost=cost,
+            balancer=self.balancer, gzip_min_bytes=self.gzip_min_bytes, affinity=affinity,
+            hedger=self.hedger, attempt_timeout=self.attempt_timeout
+        )
+
+    async def post_stream(self, url, payload, merge, headers=None, cost=0, affinity=None):
+        return await post_sse(
+            self.client, url, payload, merge, headers=headers, limiter=self.limiter,
+            retry=self.retry, rate_limiter=self.rate_limiter, cost=cost,
+            idle_timeout=self.idle_timeout, balancer=self.balancer,
+            gzip_min_bytes=self.gzip_min_bytes, affinity=affinity, hedger=self.hedger,
+            attempt_timeout=self.attempt_timeout
+        )
+
+    def record_failure(self, error):
+        self.retry.record_failure(error)
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+
+    def deduplicate(self, key):
+        """The run's `Deduplicator` keyed by the coroutine `key(data)`, or None if `dedup` is off."""
+        if self.dedup:
+            self.deduplicator = Deduplicator(key)
+        return self.deduplicator
+
+    def schedule(self, cost):
+        """The run's `CostSchedule` estimating row costs with `cost(data)`."""
+        self.cost_schedule = CostSchedule(cost, self.schedule_order, self.concurrent_requests)
+        return self.cost_schedule
+
+    def stats(self):
+        stats = {}
+        stats.update(self.telemetry.stats())
+        stats.update(self.limiter.stats())
+        stats.update(self.retry.stats())
+        if self.rate_limiter:
+            stats.update(self.rate_limiter.stats())
+        if self.cache:
+            stats.update(self.cache.stats())
+        if self.balancer:
+            stats.update(self.balancer.stats())
+        if self.deduplicator:
+            stats.update(self.deduplicator.stats())
+        if self.hedger:
+            stats.update(self.hedger.stats())
+        if self.deadline:
+            stats.update(self.deadline.stats())
+        if self.cost_schedule:
+            stats.update(self.cost_schedule.stats())
+        return stats
+
+    def summary(self):
+        limiter = self.limiter
+        summary = (
+            f"{self.telemetry.summary()}\n"
+            f"Concurrency limit: {limiter.current} (ceiling {limiter.ceiling}, range {limiter.min_limit}-{limiter.max_limit})"
+        )
+        makespan = self.cost_schedule.summary() if self.cost_schedule else None
+        return f"{summary}\n{makespan}" if makespan else summary
+
+
+class ResultWriter:
+    """
+    Crash-safe writer for `responses.jsonl`.
+
+    Every completed result is appended and flushed to `<results_file>.partial`
+    as soon as it arrives, so a crash or Ctrl-C only loses the requests still in
+    flight. Only the byte offset of each line is kept in memory; `finalize` uses
+    them to write the ordered results file and then drops the partial file.
+
+    With `keep_partial` (used on resume) an existing partial file is appended
+    to rather than truncated, since answered rows are still read from it.
+    """
+
+    def __init__(self, results_file, keep_partial=False):
+        self.results_file = results_file
+        self.partial_file = f"{results_file}.partial"
+        self.offsets = {}
+        self._f = open(self.partial_file, "ab" if keep_partial else "wb")
+        if self._f.tell() > 0:
+            # Terminate a torn last line so the next row starts on its own line
+            with open(self.partial_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._f.write(b"\n")
+
+    def write(self, request_id, entry):
+        self.offsets[request_id] = self._f.tell()
+        self._f.write((json.dumps(entry) + "\n").encode("utf-8"))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def read(self, request_id):
+        """The entry written for `request_id`."""
+        with open(self.partial_file, "rb") as f:
+            f.seek(self.offsets[request_id])
+            return json.loads(f.readline())
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+
+    def finalize(self):
+        """Write results ordered by request id, then remove the partial file."""
+        self.close()
+        tmp_file = f"{self.results_file}.tmp"
+        with open(self.partial_file, "rb") as partial, open(tmp_file, "wb") as outfile:
+            for request_id in sorted(self.offsets):
+                partial.seek(self.offsets[request_id])
+                outfile.write(partial.readline())
+        os.replace(tmp_file, self.results_file)
+        os.remove(self.partial_file)
+
+
+class Deduplicator:
+    """
+    Sends each distinct request once per run and fans its result out to the
+    rows repeating it, e.g. the same paper under several triplet rows or
+    reruns concatenated into one prompts file. Unlike the response cache this
+    stores nothing: only keys and request ids are kept, finished results are
+    read back from the `ResultWriter`.
+    """
+
+    def __init__(self, key):
+        """:param key: Coroutine `key(data)` identifying everything sent for a row."""
+        self.key = key
+        self._first = {}
+        self._duplicates = {}
+        self._waiting = {}
+        self.saved = 0
+
+    async def claim(self, data, request_id):
+        """True if the row must be sent, False if it repeats a request already claimed."""
+        key = await self.key(data)
+        if key not in self._first:
+            self._first[key] = request_id
+            return True
+        self._duplicates[request_id] = (key, data)
+        return False
+
+    def resolve(self, request_id, writer):
+        """Entries for a duplicate row: copied now if its original is written, else when it is."""
+        key, data = self._duplicates.pop(request_id)
+        original = self._first[key]
+        self.saved += 1
+        if original in writer.offsets:
+            return [self._copy(writer.read(original), data, request_id)]
+        self._waiting.setdefault(original, []).append((request_id, data))
+        return []
+
+    def fan_out(self, request_id, entry):
+        """Entries for the duplicates that were waiting for `request_id`."""
+        return [self._copy(entry, data, i) for i, data in self._waiting.pop(request_id, [])]
+
+    @staticmethod
+    def _copy(entry, data, request_id):
+        entry = {**entry, **data, "request_id": request_id, "deduplicated": True}
+        error = (request_id, entry.get("error") or "Failed") if entry.get("response") is None else None
+        return request_id, entry, error
+
+    def stats(self):
+        return {"deduplicated_requests": self.saved}
+
+
+class RunDeadline:
+    """
+    Wall-clock budget of a whole run, counted from `start`, when the run's
+    context is entered: the preflight (tokenizer, token counts) before it is
+    not counted. When it is reached, `dispatch` stops pulling prompts, cancels the
+    requests in flight and writes every row left without a result with
+    `"deadline_exceeded": true` (and no response), so the results file is
+    complete and `--resume` sends exactly those rows again.
+    """
+
+    MESSAGE = "Run deadline exceeded"
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = None
+        self.reached = False
+        self.unfinished = 0
+
+    def start(self):
+        if self.expires is None:
+            self.expires = time.monotonic() + self.seconds
+
+    def remaining(self):
+        if self.expires is None:
+            return self.seconds
+        return max(0.0, self.expires - time.monotonic())
+
+    def unfinished_entry(self, request_id, data):
+        self.unfinished += 1
+        return {"request_id": request_id, "response": None, "error": self.MESSAGE, "deadline_exceeded": True, **data}
+
+    def stats(self):
+        return {
+            "run_deadline": self.seconds,
+            "deadline_reached": self.reached,
+            "unfinished_requests": self.unfinished,
+        }
+
+
+async def dispatch(send, requests, limiter, writer, telemetry=None, total=None, window=None, dedup=None,
+                   schedule=None, deadline=None):
+    """
+    Run `send` over the `(request_id, data)` pairs, with the in-flight window
+    controlled by `limiter` (see `limits.AdaptiveLimiter`).
+
+    `requests` may be a lazy iterator: at most `window` requests (twice the
+    concurrency ceiling by default) are pulled from it and scheduled at a time,
+    so memory stays proportional to the concurrency rather than to the number of
+    prompts. Each result is stamped with its `queue_wait` and `wall_time`,
+    passed to `telemetry` and written straight to `writer`; only the success
+    count and the error messages are kept in memory. Rows repeating a request
+    already sent are answered by `dedup` (a `Deduplicator`) without taking a
+    slot. Completions are reported to `schedule` (a `schedule.CostSchedule`)
+    for its makespan estimate. Once `deadline` (a `RunDeadline`) is reached,
+    the remaining rows are cancelled and written as unfinished.
+    """
+    successful_requests = 0
+    errors = {}
+    window = window or 2 * limiter.ceiling
+    # Groups of pending rows (see `PendingRequests`) that `send` may not consume
+    affinity = getattr(requests, "affinity", None)
+
+    async def bounded(data, request_id):
+        if dedup and not await dedup.claim(data, request_id):
+            return request_id, None, None
+        queued = time.monotonic()
+        async with limiter:
+            started = time.monotonic()
+            request_id, result_data, error_data = await send(data, request_id)
+        result_data["queue_wait"] = started - queued
+        result_data["wall_time"] = time.monotonic() - started
+        return request_id, result_data, error_data
+
+    requests = iter(requests)
+    # Task -> (request_id, data)
+    in_flight = {}
+
+    def refill():
+        while len(in_flight) < window:
+            try:
+                i, data = next(requests)
+            except StopIteration:
+                return
+            in_flight[asyncio.create_task(bounded(data, i))] = (i, data)
+
+    def collect(request_id, result_data, error_data):
+        """Entries to write for a finished task."""
+        if result_data is None:
+            # A duplicate, answered from its original's result
+            return dedup.resolve(request_id, writer)
+        if telemetry:
+            telemetry.record(result_data)
+        results = [(request_id, result_data, error_data)]
+        if dedup:
+            results += dedup.fan_out(request_id, result_data)
+        return results
+
+    def unfinished(request_id, data):
+        """Entries to write for a row the deadline left without a result."""
+        entry = deadline.unfinished_entry(request_id, data)
+        results = [(request_id, entry, (request_id, entry["error"]))]
+        if dedup:
+            copies = dedup.fan_out(request_id, entry)
+            deadline.unfinished += len(copies)
+            results += copies
+        return results
+
+    def write(results):
+        nonlocal successful_requests
+        for request_id, result_data, error_data in results:
+            writer.write(request_id, result_data)
+            if affinity:
+                affinity.pop(request_id, None)
+            if schedule:
+                schedule.completed(request_id, result_data)
+            if result_data.get("response") is not None:
+                successful_requests += 1
+            if error_data:
+                errors[error_data[0]] = error_data[1]
+
+    async def expire():
+        """Cancel the requests in flight and write every row left as unfinished."""
+        deadline.reached = True
+        for task in in_flight:
+            task.cancel()
+        await asyncio.wait(in_flight)
+        for task, (i, data) in in_flight.items():
+            write(unfinished(i, data) if task.cancelled() else collect(*task.result()))
+        in_flight.clear()
+        # Rows never dispatched; answered ones are still copied over on resume
+        for i, data in requests:
+            write(unfinished(i, data))
+
+    with tqdm(total=total, desc="Processing requests") as pbar:
+        try:
+            refill()
+            while in_flight:
+                timeout = deadline.remaining() if deadline else None
+                done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    await expire()
+                else:
+                    for task in done:
+                        del in_flight[task]
+                        write(collect(*task.result()))
+                    refill()
+
+                # Rows copied over on resume are written while requests are pulled
+                pbar.set_postfix(concurrency=limiter.current, refresh=False)
+                pbar.update(len(writer.offsets) - pbar.n)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    if deadline and deadline.reached:
+        print(
+            f"\nRun deadline of {deadline.seconds}s reached: {deadline.unfinished} requests not completed, "
+            f"marked \"deadline_exceeded\" in the results (send them with --resume)"
+        )
+    return successful_requests, errors
+
+
+def run_dispatch(main, writer):
+    """Run the `main` coroutine, keeping partial results on disk if it is interrupted."""
+    try:
+        outcome = asyncio.run(main)
+    except BaseException:
+        writer.close()
+        print(f"\nInference interrupted, completed results kept in {writer.partial_file}")
+        raise
+    writer.finalize()
+    return outcome
+
+
+def write_stats(input_file, stats):
+    """Write `<input>_stats.json` next to the prompts file and return its path."""
+    input_file_name = os.path.splitext(input_file)[0]
+    stats_file_name = f"{input_file_name}_stats.json"
+
+    with open(stats_file_name, "w") as f:
+        json.dump(stats, f, indent=4)
+
+    return stats_file_name
+
+
+def print_errors(errors):
+    if errors:
+        print("=" * 20)
+        print(f"Encountered {len(errors)} errors. First 5:")
+        for i, (rid, err) in enumerate(errors.items()):
+            if i >= 5: break
+            print(f"ID {rid}: {err}")
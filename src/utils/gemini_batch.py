@@ -0,0 +1,175 @@
+"""
+Gemini Batch API jobs for large offline workloads.
+
+With `inference_gemini.py --batch`, the pending rows of a prompts file are
+written to a batch input file (one `{"key", "request"}` line per distinct
+request, attachments referenced through the Files API), which is uploaded and
+submitted as a single batch job. The job is polled until it ends and its
+responses file is mapped back to `responses.jsonl` with the same schema as
+interactive requests. Batch jobs are billed at half the interactive price and
+complete within 24 hours.
+
+The submitted job is recorded in `<results_file>.batch.json`, so a process
+restarted with the same arguments resumes polling that job instead of
+submitting a new one. Optional settings in the Gemini model YAML:
+
+    batch:
+      poll_interval: 60   # seconds between status checks
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from .engine import check_status, with_retries, encode_body
+
+SUCCEEDED = "BATCH_STATE_SUCCEEDED"
+TERMINAL_STATES = (SUCCEEDED, "BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED")
+# Longest a batch job may run; attachments must stay uploaded that long
+MAX_BATCH_SECONDS = 24 * 3600
+
+
+class BatchJob:
+    def __init__(self, ctx, base_url, api_key, model_name, results_file, poll_interval=60):
+        """
+        :param ctx: The run's `engine.InferenceContext`, for its client and retry policy.
+        """
+        self.ctx = ctx
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model_name = model_name
+        self.poll_interval = poll_interval
+        self.state_file = f"{results_file}.batch.json"
+        self.input_file = f"{results_file}.batch_input.jsonl"
+        self.output_file = f"{results_file}.batch_output.jsonl"
+        self.state = None
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as f:
+                self.state = json.load(f)
+        self.final_state = None
+
+    @property
+    def submitted(self):
+        return self.state is not None
+
+    async def submit(self, requests, uploader):
+        """
+        Write one input line per distinct key of `requests`, an async iterable
+        of `(key, request)` pairs, then upload the file with `uploader`
+        (`gemini_files.FileUploader`) and create the job. Returns the number of
+        requests submitted (0: nothing to do).
+        """
+        keys = set()
+        with open(self.input_file, "wb") as f:
+            async for key, request in requests:
+                if key in keys:
+                    continue
+                keys.add(key)
+                # Inline attachments are spliced in by encode_body, see engine.Blob
+                line, _ = encode_body({"key": key, "request": request})
+                f.write(line + b"\n")
+        if not keys:
+            os.remove(self.input_file)
+            return 0
+
+        file_info = await uploader.upload(self.input_file, "application/jsonl")
+        operation = await self._call("POST", f"/v1beta/models/{self.model_name}:batchGenerateContent", {
+            "batch": {
+                "display_name": os.path.basename(self.input_file),
+                "input_config": {"file_name": file_info["name"]},
+            }
+        })
+        self.state = {
+            "batch": operation["name"],
+            "input_file": file_info["name"],
+            "requests": len(keys),
+            "submitted": time.time(),
+        }
+        self._save()
+        os.remove(self.input_file)
+        print(f"Submitted batch job {self.state['batch']} with {len(keys)} requests")
+        return len(keys)
+
+    async def wait(self):
+        """Poll the job until it reaches a terminal state and return the final operation."""
+        last_state = None
+        while True:
+            operation = await self._call("GET", f"/v1beta/{self.state['batch']}")
+            state = (operation.get("metadata") or {}).get("state")
+            if state != last_state:
+                elapsed = time.time() - self.state["submitted"]
+                print(f"Batch job {self.state['batch']}: {state} ({elapsed / 60:.0f} min since submission)")
+                last_state = state
+            if operation.get("done") or state in TERMINAL_STATES:
+                self.final_state = state
+                return operation
+            await asyncio.sleep(self.poll_interval)
+
+    async def download(self, operation):
+        """
+        Download the job's responses file, if any, and return key -> byte offset
+        of its line in the local copy (read back with `output`).
+        """
+        responses_file = (operation.get("response") or {}).get("responsesFile")
+        if not responses_file:
+            return {}
+        url = f"{self.base_url}/download/v1beta/{responses_file}:download?alt=media"
+
+        async def attempt_once(timeout, per_attempt):
+            async with self.ctx.client.stream("GET", url, headers=self._headers) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    check_status(response, None)
+                with open(self.output_file, "wb") as f:
+                    async for chunk in response.aiter_bytes():
+                        f.write(chunk)
+
+        await with_retries(attempt_once, self.ctx.retry, None, 0)
+        index = {}
+        with open(self.output_file, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    index[json.loads(line)["key"]] = offset
+                offset += len(line)
+        return index
+
+    def output(self, offset):
+        """The responses file line at `offset`: `{"key", "response"}` or `{"key", "error"}`."""
+        with open(self.output_file, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def clear(self):
+        """Forget the job once its results are written, so the next run submits a new one."""
+        for path in (self.state_file, self.output_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @property
+    def _headers(self):
+        return {"x-goog-api-key": self.api_key, "Content-Type": "application/json"}
+
+    async def _call(self, method, path, body=None):
+        async def attempt_once(timeout, per_attempt):
+            response = await self.ctx.client.request(method, f"{self.base_url}{path}", headers=self._headers, json=body)
+            check_status(response, None)
+            return response.json()
+
+        return await with_retries(attempt_once, self.ctx.retry, None, 0)
+
+    def _save(self):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    def stats(self):
+        if not self.state:
+            return {}
+        return {
+            "batch_job": self.state["batch"],
+            "batch_state": self.final_state,
+            "batch_requests": self.state["requests"],
+        }
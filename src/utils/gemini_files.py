@@ -0,0 +1,222 @@
+"""
+Gemini Files API uploads with a persistent registry of file handles.
+
+Instead of inlining a PDF as base64 in every request, each file is uploaded
+once and referenced by `fileData.fileUri`, which shrinks requests from
+megabytes to bytes. Uploaded files live for 48 hours; the registry (digest ->
+uri, expiry) lets later runs within that window reuse them.
+
+Enable it from the Gemini model YAML:
+
+    file_upload:
+      registry: .cache/gemini_files.json
+      min_size_kb: 0        # smaller files are still sent inline
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from datetime import datetime
+
+from .engine import check_status, with_retries
+from .retry import InvalidResponseError
+
+DEFAULT_REGISTRY_PATH = ".cache/gemini_files.json"
+# Do not hand out a file that may expire while a request is still using it
+EXPIRY_MARGIN = 3600
+PROCESSING_POLL_INTERVAL = 2
+
+
+def parse_timestamp(value):
+    """Epoch seconds of an RFC 3339 timestamp such as `2025-01-01T12:00:00.123456789Z`."""
+    # fromisoformat takes at most microseconds and no `Z` before Python 3.11
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value).replace("Z", "+00:00")
+    return datetime.fromisoformat(value).timestamp()
+
+
+class FileRegistry:
+    """JSON file mapping registry keys to uploaded file handles."""
+
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        # Expired handles are useless, drop them on load
+        now = time.time()
+        self.entries = {k: v for k, v in self.entries.items() if v["expires"] > now}
+
+    def get(self, key, margin=EXPIRY_MARGIN):
+        entry = self.entries.get(key)
+        if entry and entry["expires"] - margin > time.time():
+            return entry
+        return None
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.save()
+
+    def discard(self, key, uri):
+        """Drop the entry for `key` if it still points to `uri` (not to a newer upload)."""
+        if self.entries.get(key, {}).get("uri") == uri:
+            del self.entries[key]
+            self.save()
+
+    def save(self):
+        parent = os.path.dirname(self.path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class FileUploader:
+    """Uploads attachments once per content and hands out their `fileData` parts."""
+
+    def __init__(self, ctx, base_url, api_key, files, registry_path=DEFAULT_REGISTRY_PATH, min_size_kb=0):
+        """
+        :param ctx: The run's `engine.InferenceContext`, for its client and retry policy.
+        :param base_url: API root, e.g. https://generativelanguage.googleapis.com
+        :param files: `cache.EncodedFileCache`, source of the file digests.
+        """
+        self.ctx = ctx
+        self.base_url = base_url
+        self.api_key = api_key
+        self.files = files
+        self.registry = FileRegistry(registry_path)
+        self.min_size = min_size_kb * 1024
+        # Uploads are private to a project, so handles are only valid for the same key and server
+        self._scope = hashlib.sha256(f"{base_url}|{api_key}".encode("utf-8")).hexdigest()[:16]
+        self._uploading = {}
+        # Seconds a handed-out file must remain valid; batch jobs need it for a day
+        self.expiry_margin = EXPIRY_MARGIN
+
+        self.uploaded = 0
+        self.reused = 0
+        self.uploaded_bytes = 0
+
+    def wants(self, file_path):
+        """Whether this attachment should go through the Files API."""
+        return os.path.getsize(file_path) >= self.min_size
+
+    async def file_part(self, file_path, mime_type):
+        """Return the `fileData` part referencing the uploaded file, uploading it if needed."""
+        digest = await self.files.digest(file_path)
+        key = f"{self._scope}:{digest}"
+        entry = self.registry.get(key, self.expiry_margin)
+        if entry:
+            self.reused += 1
+        else:
+            if key not in self._uploading:
+                self._uploading[key] = asyncio.ensure_future(self._upload(key, file_path, mime_type))
+            else:
+                self.reused += 1
+            entry = await asyncio.shield(self._uploading[key])
+        return {"fileData": {"mimeType": entry["mime_type"], "fileUri": entry["uri"]}}, key
+
+    def invalidate(self, key, uri):
+        """Forget a handle the server no longer knows, so the next request re-uploads."""
+        self.registry.discard(key, uri)
+
+    async def upload(self, file_path, mime_type):
+        """Upload `file_path` without registering it (e.g. a batch input file) and return its File resource."""
+        data = await asyncio.to_thread(_read_file, file_path)
+
+        async def attempt_once(timeout, per_attempt):
+            return await self._upload_once(data, mime_type, os.path.basename(file_path))
+
+        file_info = await with_retries(attempt_once, self.ctx.retry, None, 0)
+        file_info = await self._wait_until_active(file_info)
+        self.uploaded += 1
+        self.uploaded_bytes += len(data)
+        return file_info
+
+    async def _upload(self, key, file_path, mime_type):
+        try:
+            file_info = await self.upload(file_path, mime_type)
+        finally:
+            del self._uploading[key]
+
+        entry = {
+            "uri": file_info["uri"],
+            "name": file_info["name"],
+            "mime_type": file_info.get("mimeType", mime_type),
+            "expires": parse_timestamp(file_info["expirationTime"]),
+            "file_path": file_path,
+        }
+        self.registry.put(key, entry)
+        return entry
+
+    async def _upload_once(self, data, mime_type, display_name):
+        """Resumable upload protocol: start a session, then send the bytes and finalize."""
+        client = self.ctx.client
+        start = await client.post(
+            f"{self.base_url}/upload/v1beta/files",
+            headers={
+                "x-goog-api-key": self.api_key,
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(data)),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+                "Content-Type": "application/json",
+            },
+            json={"file": {"display_name": display_name}},
+        )
+        check_status(start, None)
+        upload_url = start.headers["x-goog-upload-url"]
+
+        response = await client.post(
+            upload_url,
+            headers={
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize",
+            },
+            content=data,
+        )
+        check_status(response, None)
+        return response.json()["file"]
+
+    async def _wait_until_active(self, file_info):
+        """PDFs are processed after upload and cannot be referenced before they are ACTIVE."""
+        while file_info.get("state", "ACTIVE") == "PROCESSING":
+            await asyncio.sleep(PROCESSING_POLL_INTERVAL)
+            response = await self.ctx.client.get(
+                f"{self.base_url}/v1beta/{file_info['name']}",
+                headers={"x-goog-api-key": self.api_key},
+            )
+            check_status(response, None)
+            file_info = response.json()
+        if file_info.get("state", "ACTIVE") != "ACTIVE":
+            raise InvalidResponseError(f"Upload of {file_info.get('name')} failed: {file_info.get('error')}")
+        return file_info
+
+    def stats(self):
+        return {
+            "files_uploaded": self.uploaded,
+            "files_reused": self.reused,
+            "uploaded_bytes": self.uploaded_bytes,
+        }
+
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def make_uploader(ctx, base_url, api_key, files, upload_config=None):
+    """Build a FileUploader from the `file_upload` section of a Gemini YAML, or None if absent."""
+    if not upload_config:
+        return None
+    if upload_config is True:
+        upload_config = {}
+    return FileUploader(
+        ctx, base_url, api_key, files,
+        registry_path=upload_config.get("registry", DEFAULT_REGISTRY_PATH),
+        min_size_kb=upload_config.get("min_size_kb", 0),
+    )
@@ -0,0 +1,139 @@
+"""
+Request hedging against straggling generations.
+
+A few requests of a run can take many times the median, typically because
+their replica is overloaded or a generation is stuck. With hedging enabled,
+an attempt still running after the `percentile` of recent attempt latencies
+gets a duplicate. The balancer sends the duplicate to another replica when
+there are several, and to another connection of the same server otherwise.
+The first of the two to succeed is used and the other is cancelled, which
+closes its connection (vLLM then aborts the generation). The `budget` caps
+the duplicates at a share of the attempts made, so a slow period cannot
+double the load; an attempt over budget is checked again after every further
+delay. A duplicate is a request like any other for the `rpm`/`tpm` limits,
+and none is sent while the adaptive concurrency limit is backing off from an
+overload:
+
+    hedge:
+      percentile: 95    # hedge attempts slower than this percentile of recent ones
+      budget: 0.05      # extra requests, as a share of all attempts
+      min_samples: 20   # completed attempts needed before hedging starts
+
+The percentile is taken over whole requests, so with streaming and widely
+varying response lengths, a high percentile avoids hedging long but healthy
+generations.
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+
+from .telemetry import percentile
+
+# Completed attempts the hedge delay is computed from
+LATENCY_WINDOW = 1000
+
+
+class Hedger:
+    def __init__(self, percentile=95, budget=0.05, min_samples=20, concurrent_requests=1):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        # Hedges in flight at once, on top of the run's connection pool
+        self.max_in_flight = max(1, math.ceil(budget * concurrent_requests))
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+        self.attempts = 0
+        self.hedges = 0
+        self.wins = 0
+        self.skipped = 0
+        self.in_flight = 0
+
+    def delay(self):
+        """Seconds after which an attempt is hedged, or None until enough attempts completed."""
+        if len(self._latencies) < self.min_samples:
+            return None
+        return percentile(self._latencies, self.percentile)
+
+    def _take(self, limiter=None):
+        """Reserve a hedge within the budget, unless `limiter` has shrunk its window."""
+        if (self.hedges + 1 > self.budget * self.attempts or self.in_flight >= self.max_in_flight
+                or (limiter and limiter.current < limiter.ceiling)):
+            self.skipped += 1
+            return False
+        self.hedges += 1
+        self.in_flight += 1
+        return True
+
+    def _release(self, task):
+        self.in_flight -= 1
+
+    async def _hedge(self, route, tried, admit):
+        if admit:
+            await admit()
+        return await route(tried)
+
+    async def run(self, route, admit=None, limiter=None):
+        """
+        Run `route(tried)` and, if it is still pending after the hedge delay,
+        a second `route(tried)`; return the first successful result. `tried` is
+        the list of replicas used so far (see `balancer.LoadBalancer.call`).
+        The second one waits for `admit()` (the rate limiter) and is not sent
+        while `limiter` (see `limits.AdaptiveLimiter`) is below its ceiling.
+        """
+        self.attempts += 1
+        tried = []
+        start = time.monotonic()
+        primary = asyncio.ensure_future(route(tried))
+        tasks = [primary]
+        try:
+            delay = self.delay()
+            while delay is not None and not primary.done():
+                await asyncio.wait(tasks, timeout=delay)
+                if primary.done():
+                    break
+                if self._take(limiter):
+                    hedge = asyncio.ensure_future(self._hedge(route, tried, admit))
+                    hedge.add_done_callback(self._release)
+                    tasks.append(hedge)
+                    break
+                # Over budget or backing off: check again after another delay,
+                # the budget grows with every attempt
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._latencies.append(time.monotonic() - start)
+                        if task is not primary:
+                            self.wins += 1
+                        return task.result()
+            # Both failed: the primary's error decides whether to retry
+            raise primary.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "hedged_requests": self.hedges,
+            "hedge_wins": self.wins,
+            "hedges_over_budget": self.skipped,
+            "hedge_delay": self.delay(),
+        }
+
+
+def make_hedger(hedge_config, concurrent_requests):
+    """Build a Hedger from the `hedge` section of a model YAML, or None if absent."""
+    if not hedge_config:
+        return None
+    if hedge_config is True:
+        hedge_config = {}
+    return Hedger(
+        percentile=hedge_config.get("percentile", 95),
+        budget=hedge_config.get("budget", 0.05),
+        min_samples=hedge_config.get("min_samples", 20),
+        concurrent_requests=concurrent_requests,
+    )
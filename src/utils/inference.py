@@ -1,145 +1,270 @@
-import json
-import requests
 import time
 import argparse
-import os
+import httpx
 import yaml
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from .engine import (
+    load_answered, PendingRequests, describe_error, dispatch, full_prompt, affinity_key, iter_prompts, numbered_keys,
+    InferenceContext, ResultWriter, run_dispatch, write_stats, print_errors
+)
+from .cache import make_cache_key
+from .balancer import make_endpoints
+from .telemetry import openai_usage
+from .schedule import estimate_cost
+from .limits import CHARS_PER_TOKEN
+from .sampling import aggregate_samples
+from .preflight import make_preflight, TEMPLATE_TOKENS
+from .retry import ContextOverflow
 
-def send_request(url, pload_config, data, request_id):
-    """Sends a single request to the vLLM server."""
-    headers = {"Content-Type": "application/json"}
-    prompt = data.get("prompt")
-    
-    pload = {
-        **pload_config,
-        "messages": [
-            {"role": "user", "content": prompt}
+def merge_stream_events(events):
+    """Assemble streamed chat.completion.chunk events into a chat.completion response."""
+    # Choice index -> content pieces, reasoning pieces, finish reason
+    content, reasoning, finish_reasons = {}, {}, {}
+    usage = None
+    for event in events:
+        if event.get("usage"):
+            usage = event["usage"]
+        for choice in event.get("choices", []):
+            index = choice.get("index", 0)
+            delta = choice.get("delta", {})
+            if delta.get("content"):
+                content.setdefault(index, []).append(delta["content"])
+            # Older vLLM versions name the field `reasoning_content`, newer ones `reasoning`
+            piece = delta.get("reasoning_content") or delta.get("reasoning")
+            if piece:
+                reasoning.setdefault(index, []).append(piece)
+            finish_reasons[index] = choice.get("finish_reason") or finish_reasons.get(index)
+    indices = sorted(set(content) | set(reasoning) | set(finish_reasons)) or [0]
+    return {
+        "choices": [
+            {
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": "".join(content.get(index, [])),
+                    "reasoning_content": "".join(reasoning.get(index, [])) or None,
+                },
+                "finish_reason": finish_reasons.get(index),
+            }
+            for index in indices
         ],
-        "stream": False
+        "usage": usage,
+    }
+
+def choice_sample(choice):
+    """Response, reasoning and finish reason of one chat.completion choice."""
+    message = choice["message"]
+    return {
+        # Handle cases where reasoning_content might be missing depending on model
+        "reasoning": message.get("reasoning_content", None),
+        "response": message["content"],
+        "finish_reason": choice.get("finish_reason"),
     }
 
+async def send_request(ctx, url, pload_config, data, request_id, requests=None, preflight=None):
+    """
+    Sends a single request to the vLLM server, or serves it from the response cache.
+    With a `preflight.Preflight`, rows too long for the context window fail
+    without a round trip and `max_tokens` is clamped to the room left.
+    """
+    headers = {"Content-Type": "application/json"}
+    prompt = data.get("prompt")
+    # Requests sharing a prefix are pinned to one replica when there are several
+    affinity = affinity_key(data, requests, request_id)
+
     result_entry = {}
     error_entry = None
 
     try:
-        # Reduced timeout to 300s (5 mins) to prevent massive hangs on stuck requests
-        response = requests.post(url, headers=headers, json=pload, timeout=900)
-        response.raise_for_status()
+        sent, truncated = data, False
+        pload = {**pload_config, "stream": False}
+        if preflight:
+            sent, max_tokens, truncated = preflight.check(request_id, data)
+            if "max_tokens" in pload_config:
+                pload["max_tokens"] = max_tokens
+        # Rows may split off a prefix shared with other rows (see context_cache.py);
+        # vLLM's automatic prefix caching reuses it when it comes first
+        pload["messages"] = [
+            {"role": "user", "content": full_prompt(sent)}
+        ]
+
+        # The payload carries the model name, so the host is left out of the key
+        cache_key = make_cache_key("chat/completions", pload) if ctx.cache else None
+        response_json = ctx.cache.get(cache_key) if ctx.cache else None
+        cached = response_json is not None
+        timing = {}
+
+        if response_json is None and ctx.stream:
+            stream_pload = {**pload, "stream": True, "stream_options": {"include_usage": True}}
+            response_json, timing = await ctx.post_stream(
+                url, stream_pload, merge_stream_events, headers=headers, affinity=affinity
+            )
+        elif response_json is None:
+            response_json = await ctx.post(url, pload, headers=headers, affinity=affinity)
+
+        # With several samples per prompt, all choices are kept and aggregated
+        choices = sorted(response_json["choices"], key=lambda choice: choice.get("index", 0))
+        if ctx.samples_per_prompt > 1:
+            fields = aggregate_samples([choice_sample(choice) for choice in choices], ctx.aggregate)
+        else:
+            fields = choice_sample(choices[0])
 
-        response_json = response.json()
-        
-        # Handle cases where reasoning_content might be missing depending on model
-        message = response_json["choices"][0]["message"]
-        reasoning = message.get("reasoning_content", None)
-        
         result_entry = {
             "request_id": request_id,
-            "reasoning": reasoning,
-            "response": message["content"],
+            **fields,
+            "cached": cached,
+            **openai_usage(response_json),
+            **timing,
             **data
         }
+        if truncated:
+            result_entry["truncated"] = True
+        if ctx.cache:
+            ctx.cache.put(cache_key, response_json)
     except Exception as e:
-        error_entry = (request_id, str(e))
+        ctx.record_failure(e)
+        error_entry = (request_id, describe_error(e))
         result_entry = {
             "request_id": request_id,
             "prompt": prompt,
             "response": None,
             **data
         }
-    
+        if isinstance(e, ContextOverflow):
+            result_entry.update({"error": describe_error(e), "context_overflow": True})
+
     return request_id, result_entry, error_entry
 
-def run_inference(config_path, input_file, results_file):
-    """Run batch inference with config file using ThreadPoolExecutor."""
+def request_cost(data, pload_config):
+    """Estimated cost of a row for the dispatch schedule, see schedule.py."""
+    return estimate_cost(len(full_prompt(data)) // CHARS_PER_TOKEN, pload_config.get("max_tokens"))
+
+def fetch_max_model_len(base_url, model):
+    """Context window vLLM reports for `model` on /v1/models, or None."""
+    try:
+        response = httpx.get(f"{base_url}/v1/models", timeout=10)
+        response.raise_for_status()
+        served = response.json().get("data", [])
+    except (httpx.HTTPError, ValueError):
+        return None
+    for entry in served:
+        # A single served model answers to any name
+        if entry.get("id") == model or len(served) == 1:
+            return entry.get("max_model_len")
+    return None
+
+async def _run(ctx, url, pload_config, requests, writer, preflight=None):
+    async with ctx:
+        async def send(data, request_id):
+            return await send_request(ctx, url, pload_config, data, request_id, requests, preflight)
+
+        # Identical prompts are sent once, their response fans out to every row
+        async def dedup_key(data):
+            return make_cache_key(url, pload_config, full_prompt(data))
+
+        return await dispatch(
+            send, requests, ctx.limiter, writer, ctx.telemetry, total=requests.total,
+            dedup=ctx.deduplicate(dedup_key), schedule=requests.schedule, deadline=ctx.deadline
+        )
+
+def run_inference(config_path, input_file, results_file, resume=False, use_cache=True, deadline=None):
+    """
+    Run batch inference with config file on a single asyncio event loop.
+    `deadline` (seconds) overrides the config's `run_deadline`.
+    """
     with open(config_path, "r") as f:
         config = yaml.safe_load(f)
-    
-    hostname = config.pop("hostname")
-    port = config.pop("port")
-    # This now controls actual thread count, not just active requests
-    concurrent_requests = config.pop("concurrent_requests", 10)
-    
-    url = f"http://{hostname}:{port}/v1/chat/completions"
+    if deadline is not None:
+        config["run_deadline"] = deadline
+
+    # One or several replicas, `hostname`/`port` may be lists
+    endpoints = make_endpoints(config.pop("hostname"), config.pop("port"))
+    # Concurrency, retries, rate limits, cache, streaming and load balancing settings
+    ctx = InferenceContext(config, use_cache=use_cache, endpoints=endpoints)
+
+    # Routed to one of the endpoints by the balancer on every attempt
+    url = "/v1/chat/completions"
+    preflight_config = config.pop("preflight", None)
     pload_config = config
-    
-    dataset = []
-    with open(input_file, "r") as f:
-        for line in f:
-            if line.strip(): # Skip empty lines
-                dataset.append(json.loads(line))
-
-    results = {}
-    errors = {}
-    start_time = time.time()
+    if ctx.samples_per_prompt > 1:
+        pload_config["n"] = ctx.samples_per_prompt
 
-    print(f"Starting inference with {concurrent_requests} concurrent workers...")
+    # Requests are identified by prompt and payload config, not by their position
+    answered = load_answered(results_file, pload_config) if resume else {}
 
-    # USE THREADPOOLEXECUTOR INSTEAD OF RAW THREADS
-    with ThreadPoolExecutor(max_workers=concurrent_requests) as executor:
-        # Submit all tasks to the pool
-        future_to_req = {
-            executor.submit(send_request, url, pload_config, data, i): i 
-            for i, data in enumerate(dataset)
-        }
+    # Prompt tokens of every pending row, checked against the context window before sending anything
+    preflight = make_preflight(
+        preflight_config,
+        lambda data, tokens: tokens(full_prompt(data)) + TEMPLATE_TOKENS,
+        max_tokens=pload_config.get("max_tokens"),
+        context_window=lambda: fetch_max_model_len(endpoints[0], pload_config.get("model")),
+        samples=ctx.samples_per_prompt,
+    )
+    if preflight:
+        key = numbered_keys(pload_config)
+        preflight.scan(
+            iter_prompts(input_file),
+            skip=(lambda data: key(data) in answered) if answered else None
+        )
+        print(preflight.summary())
 
-        # Process results as they complete
-        with tqdm(total=len(dataset), desc="Processing requests") as pbar:
-            for future in as_completed(future_to_req):
-                request_id, result_data, error_data = future.result()
-                
-                results[request_id] = result_data
-                if error_data:
-                    errors[error_data[0]] = error_data[1]
-                
-                pbar.update(1)
+    writer = ResultWriter(results_file, keep_partial=resume)
+    # Prompts are read lazily, answered ones are copied over as they are reached
+    schedule = ctx.schedule(lambda data: request_cost(data, pload_config))
+    requests = PendingRequests(
+        input_file, answered, pload_config, writer, order_by_prefix=ctx.order_by_prefix, schedule=schedule,
+        affinity=ctx.balancer.pins_prefixes
+    )
+    if resume:
+        print(f"Resuming: {len(answered)} answered requests found in previous results.")
 
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+    start_time = time.time()
 
-    # Write sorted results
-    sorted_results = [results[i] for i in sorted(results.keys())]
+    print(f"Starting inference on {len(endpoints)} endpoint(s) with up to {ctx.concurrent_requests} concurrent requests...")
 
-    with open(results_file, "w") as outfile:
-        for result in sorted_results:
-            json.dump(result, outfile)
-            outfile.write('\n')
+    successful_requests, errors = run_dispatch(
+        _run(ctx, url, pload_config, requests, writer, preflight),
+        writer
+    )
 
-    successful_requests = sum(1 for res in results.values() if res.get("response") is not None)
-    total_requests = len(dataset)
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+    ctx.close()
+
+    # Throughput only counts requests actually sent in this run
     throughput = successful_requests / elapsed_time if elapsed_time > 0 else 0
+    resumed_requests = requests.resumed
+    successful_requests += resumed_requests
+    total_requests = requests.total
 
     stats = {
         "total_requests": total_requests,
         "successful_requests": successful_requests,
         "failed_requests": total_requests - successful_requests,
         "failed_request_ids": list(errors.keys()),
+        "resumed_requests": resumed_requests,
         "elapsed_time": elapsed_time,
         "throughput": throughput,
     }
+    stats.update(ctx.stats())
+    if preflight:
+        stats.update(preflight.stats())
 
-    input_file_name = os.path.splitext(input_file)[0]
-    stats_file_name = f"{input_file_name}_stats.json"
-
-    with open(stats_file_name, "w") as f:
-        json.dump(stats, f, indent=4)
+    stats_file_name = write_stats(input_file, stats)
 
     print(f"\nStatistics written to {stats_file_name}")
     print(f"Throughput: {throughput:.2f} requests/second")
+    print(ctx.summary())
 
-    if errors:
-        print("=" * 20)
-        print(f"Encoutered {len(errors)} errors. First 5:")
-        for i, (rid, err) in enumerate(errors.items()):
-            if i >= 5: break
-            print(f"ID {rid}: {err}")
+    print_errors(errors)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch inference script for vLLM server.")
     parser.add_argument("--config", type=str, required=True, help="YAML config file")
     parser.add_argument("--input-file", type=str, required=True, help="JSONL file with input prompts")
     parser.add_argument("--results-file", type=str, required=True, help="Output file for results (JSONL)")
+    parser.add_argument("--resume", action="store_true", help="Only send requests without a response in the existing results file")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass response cache lookups (fresh responses are still stored)")
+    parser.add_argument("--deadline", type=float, default=None, help="Stop the run after this many seconds, keeping what completed")
     args = parser.parse_args()
 
-    run_inference(args.config, args.input_file, args.results_file)
\ No newline at end of file
+    run_inference(args.config, args.input_file, args.results_file, resume=args.resume, use_cache=not args.no_cache, deadline=args.deadline)
@@ -1,16 +1,29 @@
-import json
-import requests
 import time
+import asyncio
+import functools
 import argparse
 import os
 import yaml
-import base64
+import re
 import mimetypes
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
+from .engine import (
+    load_answered, PendingRequests, describe_error, dispatch, full_prompt, iter_prompts, request_key, numbered_keys,
+    InferenceContext, ResultWriter, run_dispatch, write_stats, print_errors, Blob
+)
+from .cache import make_cache_key, EncodedFileCache
+from .retry import InvalidResponseError, RequestError, ContextOverflow
+from .telemetry import gemini_usage
+from .gemini_files import make_uploader
+from .gemini_batch import BatchJob, MAX_BATCH_SECONDS
+from .context_cache import make_context_caches
+from .schedule import estimate_cost
+from .limits import CHARS_PER_TOKEN
+from .sampling import aggregate_samples
+from .preflight import make_preflight
 
-def encode_file_to_base64(file_path):
-    """Read and encode file to base64, also detect MIME type."""
+def guess_mime_type(file_path):
+    """Detect the MIME type of an attachment from its extension."""
     mime_type, _ = mimetypes.guess_type(file_path)
     
     # Fallback MIME type detection based on extension
@@ -25,14 +38,181 @@ def encode_file_to_base64(file_path):
             '.gif': 'image/gif'
         }
         mime_type = mime_map.get(ext, 'application/octet-stream')
-    
+    return mime_type
+
+# Rough token costs for client-side TPM limiting, before the API has counted anything
+PDF_TOKENS_PER_PAGE = 258 + 500  # Rendered page image plus its extracted text
+IMAGE_TOKENS = 258
+BYTES_PER_PDF_PAGE = 100_000  # Fallback when the page objects cannot be found
+
+@functools.lru_cache(maxsize=4096)
+def _count_pdf_pages(file_path, mtime_ns, size):
+    """Page objects in a PDF, memoized per version of the file."""
     with open(file_path, "rb") as f:
-        file_data = base64.b64encode(f.read()).decode('utf-8')
+        pages = len(re.findall(rb"/Type\s*/Page\b(?!s)", f.read()))
+    return pages or max(1, size // BYTES_PER_PDF_PAGE)
+
+def estimate_tokens(prompt, file_path=None):
+    """Estimate the input tokens of a request from the prompt length and attached file."""
+    tokens = len(prompt or "") // CHARS_PER_TOKEN
+    if file_path:
+        ext = os.path.splitext(file_path)[1].lower()
+        st = os.stat(file_path)
+        size = st.st_size
+        if ext == ".pdf":
+            pages = _count_pdf_pages(os.path.abspath(file_path), st.st_mtime_ns, size)
+            tokens += pages * PDF_TOKENS_PER_PAGE
+        elif ext in (".png", ".jpg", ".jpeg", ".webp", ".gif"):
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += size // CHARS_PER_TOKEN
+    return tokens
+
+def prompt_tokens(data):
+    """Estimated input tokens of a row, its prompt alone if the attachment cannot be read."""
+    text = full_prompt(data)
+    try:
+        return estimate_tokens(text, data.get("file_path"))
+    except OSError:
+        return len(text) // CHARS_PER_TOKEN  # Reported when the request is sent
+
+def output_tokens(generation_config):
+    """Output tokens a request may use: maxOutputTokens plus the thinking budget, None if unbounded."""
+    thinking = (generation_config.get("thinkingConfig") or {}).get("thinkingBudget")
+    if generation_config.get("maxOutputTokens") is None:
+        return None
+    return generation_config["maxOutputTokens"] + max(thinking or 0, 0)
+
+def request_cost(data, generation_config):
+    """Estimated cost of a row for the dispatch schedule, see schedule.py."""
+    return estimate_cost(prompt_tokens(data), output_tokens(generation_config))
+
+def fetch_input_token_limit(base_url, model_name, api_key):
+    """Input token limit of the model from the models endpoint, or None."""
+    try:
+        response = httpx.get(f"{base_url}/v1beta/models/{model_name}", headers={"x-goog-api-key": api_key}, timeout=10)
+        response.raise_for_status()
+        return response.json().get("inputTokenLimit")
+    except (httpx.HTTPError, ValueError):
+        return None
+
+def merge_stream_events(events):
+    """Assemble streamed GenerateContentResponse chunks into a single response."""
+    # Candidate index -> text pieces, thought pieces, finish reason
+    texts, thoughts, finish_reasons = {}, {}, {}
+    usage = None
+    prompt_feedback = None
+    for event in events:
+        usage = event.get("usageMetadata", usage)
+        prompt_feedback = prompt_feedback or event.get("promptFeedback")
+        for candidate in event.get("candidates", []):
+            index = candidate.get("index", 0)
+            for part in candidate.get("content", {}).get("parts", []):
+                if "text" not in part:
+                    continue
+                (thoughts if part.get("thought") else texts).setdefault(index, []).append(part["text"])
+            finish_reasons[index] = candidate.get("finishReason") or finish_reasons.get(index)
+
+    merged = {"usageMetadata": usage}
+    if prompt_feedback:
+        merged["promptFeedback"] = prompt_feedback
+    indices = sorted(set(texts) | set(thoughts) | {i for i, reason in finish_reasons.items() if reason})
+    if indices:
+        merged["candidates"] = []
+        for index in indices:
+            parts = [{"text": "".join(texts.get(index, []))}]
+            if index in thoughts:
+                parts.append({"text": "".join(thoughts[index]), "thought": True})
+            merged["candidates"].append({
+                "content": {"parts": parts, "role": "model"},
+                "finishReason": finish_reasons.get(index),
+                "index": index,
+            })
+    return merged
+
+async def attachment_part(file_path, files, uploader=None):
+    """
+    The part attaching `file_path` and its upload key: a Files API reference
+    when `uploader` takes the file, else inline base64. The encoding is shared
+    by every request attaching the same file and spliced into the request body
+    without copies.
+    """
+    mime_type = guess_mime_type(file_path)
+    if uploader and uploader.wants(file_path):
+        return await uploader.file_part(file_path, mime_type)
+    _, file_data = await files.encode(file_path)
+    return {"inlineData": {"mimeType": mime_type, "data": Blob(file_data)}}, None
+
+def parse_response(response_json):
+    """Answer text and finish reason of a GenerateContentResponse, or InvalidResponseError."""
+    candidates = response_json.get("candidates", [])
+    
+    if not candidates:
+        prompt_feedback = response_json.get("promptFeedback", {})
+        raise InvalidResponseError(f"No candidates returned. Feedback: {prompt_feedback}")
     
-    return file_data, mime_type
+    return parse_candidate(candidates[0])
 
-def send_request(url, generation_config, api_key, data, request_id):
-    """Sends a single request to the Google Gemini API with optional file attachment."""
+def parse_candidate(candidate):
+    """Answer text and finish reason of one candidate, or InvalidResponseError."""
+    finish_reason = candidate.get("finishReason")
+    
+    # Check if content was generated
+    if "content" in candidate and "parts" in candidate["content"]:
+        text_content = candidate["content"]["parts"][0]["text"]
+    else:
+        text_content = None
+        if finish_reason != "STOP":
+            raise InvalidResponseError(f"Generation stopped due to: {finish_reason}")
+    return text_content, finish_reason
+
+def response_fields(response_json, ctx):
+    """
+    `reasoning`, `response` and `finish_reason` of a GenerateContentResponse;
+    with several samples per prompt, aggregated over its candidates, which are
+    kept under `samples` (see sampling.py).
+    """
+    if ctx.samples_per_prompt <= 1:
+        text_content, finish_reason = parse_response(response_json)
+        return {"reasoning": None, "response": text_content, "finish_reason": finish_reason}
+    candidates = response_json.get("candidates", [])
+    if not candidates:
+        parse_response(response_json)  # Raises with the prompt feedback
+    samples = []
+    for candidate in sorted(candidates, key=lambda candidate: candidate.get("index", 0)):
+        try:
+            text_content, finish_reason = parse_candidate(candidate)
+            samples.append({"reasoning": None, "response": text_content, "finish_reason": finish_reason})
+        except InvalidResponseError as e:
+            samples.append({"reasoning": None, "response": None, "finish_reason": candidate.get("finishReason"), "error": str(e)})
+    return aggregate_samples(samples, ctx.aggregate)
+
+async def lookup_cache(ctx, url, generation_config, data, files):
+    """Cached response of a row (or None) and its cache key, without encoding the attachment."""
+    if not ctx.cache:
+        return None, None
+    file_path = data.get("file_path")
+    try:
+        digest = await files.digest(file_path) if file_path else None
+    except OSError:
+        return None, None  # Unreadable file, reported by the encoding step
+    cache_key = make_cache_key(url, generation_config, full_prompt(data), digest)
+    return ctx.cache.get(cache_key), cache_key
+
+async def send_request(ctx, url, generation_config, api_key, data, request_id,
+                       files=None, uploader=None, caches=None, preflight=None):
+    """
+    Sends a single request to the Google Gemini API with optional file attachment,
+    or serves it from the response cache.
+
+    :param files: `cache.EncodedFileCache` shared by the run's requests.
+    :param uploader: `gemini_files.FileUploader`, to reference attachments
+        through the Files API instead of inlining them.
+    :param caches: `context_cache.ContextCaches`, to send a row's shared
+        `prefix` as cached content.
+    :param preflight: `preflight.Preflight`, failing rows too long for the
+        model's input token limit without a round trip.
+    """
     
     headers = {
         "Content-Type": "application/json",
@@ -41,25 +221,46 @@ def send_request(url, generation_config, api_key, data, request_id):
     
     prompt = data.get("prompt")
     file_path = data.get("file_path")
+    files = files or EncodedFileCache(0)
+
+    sent, truncated = data, False
+    if preflight:
+        try:
+            sent, _, truncated = preflight.check(request_id, data)
+        except ContextOverflow as e:
+            ctx.record_failure(e)
+            result_entry = {
+                "request_id": request_id,
+                "prompt": prompt,
+                "response": None,
+                "error": describe_error(e),
+                "context_overflow": True,
+                **data
+            }
+            return request_id, result_entry, (request_id, describe_error(e))
+    # Rows may split off a prefix shared with other rows, the model sees prefix + prompt
+    prefix = sent.get("prefix") or ""
+    text = full_prompt(sent)
+    
+    # Look the request up before encoding anything, the key only needs the file digest
+    response_json, cache_key = await lookup_cache(ctx, url, generation_config, sent, files)
+    timing = {}
     
     # Build parts array
     parts = []
     
     # Add text prompt
-    if prompt:
-        parts.append({"text": prompt})
+    if text:
+        parts.append({"text": text})
 
     # Add file if provided
-    if file_path:
+    upload_key = None
+    if file_path and response_json is None:
         try:
-            file_data, mime_type = encode_file_to_base64(file_path)
-            parts.append({
-                "inlineData": {
-                    "mimeType": mime_type,
-                    "data": file_data
-                }
-            })
+            file_part, upload_key = await attachment_part(file_path, files, uploader)
+            parts.append(file_part)
         except Exception as e:
+            ctx.record_failure(e)
             error_entry = (request_id, f"File encoding error: {str(e)}")
             result_entry = {
                 "request_id": request_id,
@@ -83,118 +284,287 @@ def send_request(url, generation_config, api_key, data, request_id):
     result_entry = {}
     error_entry = None
     
+    cached = response_json is not None
+    cache_name = None
     try:
-        # Timeout set to 60s per request, adjust as needed
-        response = requests.post(url, headers=headers, json=payload, timeout=900)
-        
-        # Check for HTTP errors
-        if response.status_code != 200:
+        if response_json is None:
+            if caches and prefix:
+                cache_name = await caches.get(prefix)
+                if cache_name:
+                    # The prefix is already in the cached content, only send the rest
+                    payload["cachedContent"] = cache_name
+                    parts[0] = {"text": sent.get("prompt") or ""}
+
+            cost = 0
+            if ctx.rate_limiter and ctx.rate_limiter.tokens:
+                cost = await asyncio.to_thread(estimate_tokens, text, file_path)
+            # Both raise RequestError("HTTP <status>: <message>") on non-200 responses
+            async def post():
+                if ctx.stream:
+                    stream_url = url.replace(":generateContent", ":streamGenerateContent") + "?alt=sse"
+                    return await ctx.post_stream(
+                        stream_url, payload, merge_stream_events, headers=headers, cost=cost
+                    )
+                return await ctx.post(url, payload, headers=headers, cost=cost), {}
+
             try:
-                err_msg = response.json().get('error', {}).get('message', response.text)
-            except:
-                err_msg = response.text
-            raise Exception(f"HTTP {response.status_code}: {err_msg}")
-        
-        response_json = response.json()
+                response_json, timing = await post()
+            except RequestError as e:
+                message = str(e).lower()
+                stale_file = upload_key and "file" in message
+                stale_cache = cache_name and "cachedcontent" in message
+                if e.status not in (400, 403, 404) or not (stale_file or stale_cache):
+                    raise
+                # The uploaded file or cached content is gone (deleted or expired early):
+                # create it again and retry, once
+                if stale_file:
+                    uploader.invalidate(upload_key, parts[-1]["fileData"]["fileUri"])
+                    parts[-1], upload_key = await uploader.file_part(file_path, guess_mime_type(file_path))
+                if stale_cache:
+                    caches.invalidate(prefix, cache_name)
+                    cache_name = await caches.get(prefix)
+                    if cache_name:
+                        payload["cachedContent"] = cache_name
+                    else:
+                        payload.pop("cachedContent")
+                        parts[0] = {"text": text}
+                response_json, timing = await post()
         
         # Parse Gemini Response
-        candidates = response_json.get("candidates", [])
-        
-        if not candidates:
-            prompt_feedback = response_json.get("promptFeedback", {})
-            raise Exception(f"No candidates returned. Feedback: {prompt_feedback}")
-        
-        candidate = candidates[0]
-        finish_reason = candidate.get("finishReason")
-        
-        # Check if content was generated
-        if "content" in candidate and "parts" in candidate["content"]:
-            text_content = candidate["content"]["parts"][0]["text"]
-        else:
-            text_content = None
-            if finish_reason != "STOP":
-                raise Exception(f"Generation stopped due to: {finish_reason}")
-        
-        reasoning = None 
-        
         result_entry = {
             "request_id": request_id,
-            "reasoning": reasoning,
-            "response": text_content,
-            "finish_reason": finish_reason,
+            **response_fields(response_json, ctx),
+            "cached": cached,
+            **gemini_usage(response_json),
+            **timing,
             **data
         }
+        if truncated:
+            result_entry["truncated"] = True
+        if cache_key:
+            ctx.cache.put(cache_key, response_json)
         
     except Exception as e:
-        error_entry = (request_id, str(e))
+        ctx.record_failure(e)
+        error_entry = (request_id, describe_error(e))
         result_entry = {
             "request_id": request_id,
             "prompt": prompt,
             "response": None,
-            "error": str(e),
+            "error": describe_error(e),
             **data
         }
     
     return request_id, result_entry, error_entry
 
-def run_inference(config_path, input_file, results_file, api_key):
-    """Run batch inference with config file using ThreadPoolExecutor."""
+async def _run(ctx, url, generation_config, api_key, files, uploader, caches, requests, writer, preflight=None):
+    async with ctx:
+        async def send(data, request_id):
+            return await send_request(
+                ctx, url, generation_config, api_key, data, request_id,
+                files=files, uploader=uploader, caches=caches, preflight=preflight
+            )
+        # Identical prompts and attachments are sent once, the response fans out to every row
+        async def dedup_key(data):
+            file_path = data.get("file_path")
+            try:
+                digest = await files.digest(file_path) if file_path else None
+            except OSError:
+                digest = file_path  # Unreadable file, reported by send_request
+            return make_cache_key(url, generation_config, full_prompt(data), digest)
+
+        try:
+            return await dispatch(
+                send, requests, ctx.limiter, writer, ctx.telemetry, total=requests.total,
+                dedup=ctx.deduplicate(dedup_key), schedule=requests.schedule, deadline=ctx.deadline
+            )
+        finally:
+            if caches:
+                await caches.close()
+
+async def _run_batch(ctx, job, url, generation_config, key_config, files, uploader, requests, writer):
+    """
+    Submit the pending rows as a batch job, unless one is already recorded for
+    these results, wait for it to end and write the results of every row.
+    """
+    async with ctx:
+        if not job.submitted:
+            async def batch_requests():
+                numbered = numbered_keys(key_config)
+                for data in iter_prompts(requests.input_file):
+                    key, n = numbered(data)
+                    if (key, n) in requests.answered:
+                        continue
+                    response_json, _ = await lookup_cache(ctx, url, generation_config, data, files)
+                    if response_json is not None:
+                        continue
+                    parts = [{"text": full_prompt(data)}]
+                    if data.get("file_path"):
+                        parts.append((await attachment_part(data["file_path"], files, uploader))[0])
+                    yield key, {"contents": [{"parts": parts}], "generationConfig": generation_config}
+
+            await job.submit(batch_requests(), uploader)
+        if job.submitted:
+            try:
+                wait = job.wait()
+                operation = await (asyncio.wait_for(wait, ctx.deadline.remaining()) if ctx.deadline else wait)
+            except asyncio.CancelledError:
+                print(f"\nBatch job {job.state['batch']} keeps running, rerun the same command to resume polling it")
+                raise
+            except asyncio.TimeoutError:
+                # Run deadline: the job keeps running, the next run polls it again
+                ctx.deadline.reached = True
+                print(f"\nRun deadline reached, batch job {job.state['batch']} keeps running, rerun the same command to resume polling it")
+                errors = {}
+                for request_id, data in requests:
+                    entry = ctx.deadline.unfinished_entry(request_id, data)
+                    writer.write(request_id, entry)
+                    errors[request_id] = entry["error"]
+                return 0, errors
+            outputs = await job.download(operation)
+        else:
+            operation, outputs = {}, {}
+
+    successful_requests = 0
+    errors = {}
+    for request_id, data in requests:
+        key = request_key(data, key_config)
+        response_json, cache_key = None, None
+        cached = key not in outputs
+        try:
+            if cached:
+                response_json, cache_key = await lookup_cache(ctx, url, generation_config, data, files)
+                if response_json is None:
+                    status = (operation.get("error") or {}).get("message") or job.final_state
+                    raise InvalidResponseError(f"Missing from batch output (job {status})")
+            else:
+                output = job.output(outputs[key])
+                if "response" not in output:
+                    raise InvalidResponseError(f"Batch request failed: {output.get('error') or output.get('status')}")
+                response_json = output["response"]
+            result_entry = {
+                "request_id": request_id,
+                **response_fields(response_json, ctx),
+                "cached": cached,
+                **gemini_usage(response_json),
+                **data
+            }
+            if not cached and ctx.cache:
+                _, cache_key = await lookup_cache(ctx, url, generation_config, data, files)
+                ctx.cache.put(cache_key, response_json)
+            successful_requests += 1
+        except Exception as e:
+            ctx.record_failure(e)
+            errors[request_id] = describe_error(e)
+            result_entry = {
+                "request_id": request_id,
+                "prompt": data.get("prompt"),
+                "response": None,
+                "error": describe_error(e),
+                **data
+            }
+        writer.write(request_id, result_entry)
+        ctx.telemetry.record(result_entry)
+    ctx.telemetry.stop()
+    # Results are on disk (or the job failed): the next run submits a new job
+    job.clear()
+    return successful_requests, errors
+
+def run_inference(config_path, input_file, results_file, api_key, resume=False, use_cache=True, batch=False,
+                  deadline=None):
+    """
+    Run batch inference with config file on a single asyncio event loop.
+    `deadline` (seconds) overrides the config's `run_deadline`.
+    """
     with open(config_path, "r") as f:
         config = yaml.safe_load(f)
+    if deadline is not None:
+        config["run_deadline"] = deadline
     
     # Extract connection specific details
     model_name = config.pop("model_name", "gemini-2.0-flash")
-    concurrent_requests = config.pop("concurrent_requests", 10)
+    # Concurrency, retries, rate limits, cache and streaming settings
+    ctx = InferenceContext(config, use_cache=use_cache)
+    # Encoded attachments kept in memory across requests
+    files = EncodedFileCache(config.pop("file_cache_mb", 512))
     
-    # Google API Endpoint
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
+    # Google API Endpoint, overridable to point at a proxy or a local mock
+    base_url = config.pop("base_url", "https://generativelanguage.googleapis.com").rstrip("/")
+    url = f"{base_url}/v1beta/models/{model_name}:generateContent"
+    # Optional Files API uploads instead of inline base64
+    uploader = make_uploader(ctx, base_url, api_key, files, config.pop("file_upload", None))
+    # Optional context caching of prompt prefixes shared by several rows
+    caches = make_context_caches(ctx, base_url, api_key, model_name, config.pop("context_cache", None))
+    # Batch jobs always reference attachments through the Files API
+    batch_config = config.pop("batch", None) or {}
+    job = None
+    if batch:
+        uploader = uploader or make_uploader(ctx, base_url, api_key, files, True)
+        uploader.expiry_margin += MAX_BATCH_SECONDS
+        job = BatchJob(ctx, base_url, api_key, model_name, results_file, batch_config.get("poll_interval", 60))
     
+    preflight_config = config.pop("preflight", None)
     # Remaining config keys (temp, top_p, thinkingConfig) become generationConfig
     generation_config = config
+    if ctx.samples_per_prompt > 1:
+        generation_config["candidateCount"] = ctx.samples_per_prompt
     
-    dataset = []
-    with open(input_file, "r") as f:
-        for line in f:
-            if line.strip(): # Skip empty lines
-                dataset.append(json.loads(line))
+    # Requests are identified by prompt, attachment and everything sent to the model
+    key_config = {"model": model_name, **generation_config}
+    answered = load_answered(results_file, key_config) if resume else {}
     
-    results = {}
-    errors = {}
+    # Estimated input tokens of every pending row, checked against the model's
+    # input token limit before sending anything; batch jobs are only counted
+    preflight = make_preflight(
+        preflight_config,
+        lambda data, tokens: prompt_tokens(data),
+        max_tokens=output_tokens(generation_config),
+        context_window=lambda: fetch_input_token_limit(base_url, model_name, api_key),
+        samples=ctx.samples_per_prompt,
+        shared_window=False,
+        tokenizer=False,
+        guard=not batch,
+    )
+    if preflight:
+        key = numbered_keys(key_config)
+        preflight.scan(
+            iter_prompts(input_file),
+            skip=(lambda data: key(data) in answered) if answered else None
+        )
+        print(preflight.summary())
+
+    writer = ResultWriter(results_file, keep_partial=resume)
+    # Prompts are read lazily, answered ones are copied over as they are reached;
+    # a batch job runs them in the service's own order
+    schedule = None if batch else ctx.schedule(lambda data: request_cost(data, generation_config))
+    requests = PendingRequests(
+        input_file, answered, key_config, writer, order_by_prefix=ctx.order_by_prefix, schedule=schedule
+    )
+    if resume:
+        print(f"Resuming: {len(answered)} answered requests found in previous results.")
     
     start_time = time.time()
-    print(f"Starting inference on {model_name} with {concurrent_requests} concurrent workers...")
+    if job:
+        if job.submitted:
+            print(f"Resuming batch job {job.state['batch']} recorded in {job.state_file}")
+        else:
+            print(f"Submitting a batch job on {model_name}...")
+        main = _run_batch(ctx, job, url, generation_config, key_config, files, uploader, requests, writer)
+    else:
+        print(f"Starting inference on {model_name} with up to {ctx.concurrent_requests} concurrent requests...")
+        main = _run(ctx, url, generation_config, api_key, files, uploader, caches, requests, writer, preflight)
     
-    with ThreadPoolExecutor(max_workers=concurrent_requests) as executor:
-        # Submit all tasks to the pool
-        future_to_req = {
-            executor.submit(send_request, url, generation_config, api_key, data, i): i 
-            for i, data in enumerate(dataset)
-        }
-        
-        # Process results as they complete
-        with tqdm(total=len(dataset), desc="Processing requests") as pbar:
-            for future in as_completed(future_to_req):
-                request_id, result_data, error_data = future.result()
-                
-                results[request_id] = result_data
-                if error_data:
-                    errors[error_data[0]] = error_data[1]
-                
-                pbar.update(1)
+    successful_requests, errors = run_dispatch(main, writer)
     
     end_time = time.time()
     elapsed_time = end_time - start_time
+    ctx.close()
     
-    # Write sorted results
-    sorted_results = [results[i] for i in sorted(results.keys())]
-    with open(results_file, "w") as outfile:
-        for result in sorted_results:
-            json.dump(result, outfile)
-            outfile.write('\n')
-    
-    successful_requests = sum(1 for res in results.values() if res.get("response") is not None)
-    total_requests = len(dataset)
+    # Throughput only counts requests actually sent in this run
     throughput = successful_requests / elapsed_time if elapsed_time > 0 else 0
+    resumed_requests = requests.resumed
+    successful_requests += resumed_requests
+    total_requests = requests.total
     
     stats = {
         "model": model_name,
@@ -202,32 +572,39 @@ def run_inference(config_path, input_file, results_file, api_key):
         "successful_requests": successful_requests,
         "failed_requests": total_requests - successful_requests,
         "failed_request_ids": list(errors.keys()),
+        "resumed_requests": resumed_requests,
         "elapsed_time": elapsed_time,
         "throughput": throughput,
     }
+    stats.update(ctx.stats())
+    stats.update(files.stats())
+    if uploader:
+        stats.update(uploader.stats())
+    if caches:
+        stats.update(caches.stats())
+    if job:
+        stats.update(job.stats())
+    if preflight:
+        stats.update(preflight.stats())
     
-    input_file_name = os.path.splitext(input_file)[0]
-    stats_file_name = f"{input_file_name}_stats.json"
-    
-    with open(stats_file_name, "w") as f:
-        json.dump(stats, f, indent=4)
+    stats_file_name = write_stats(input_file, stats)
     
     print(f"\nStatistics written to {stats_file_name}")
     print(f"Throughput: {throughput:.2f} requests/second")
+    print(ctx.summary())
     
-    if errors:
-        print("=" * 20)
-        print(f"Encountered {len(errors)} errors. First 5:")
-        for i, (rid, err) in enumerate(errors.items()):
-            if i >= 5: break
-            print(f"ID {rid}: {err}")
+    print_errors(errors)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Batch inference script for Google Gemini API.")
     parser.add_argument("--config", type=str, required=True, help="YAML config file")
     parser.add_argument("--input-file", type=str, required=True, help="JSONL file with input prompts")
     parser.add_argument("--results-file", type=str, required=True, help="Output file for results (JSONL)")
+    parser.add_argument("--resume", action="store_true", help="Only send requests without a response in the existing results file")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass response cache lookups (fresh responses are still stored)")
+    parser.add_argument("--batch", action="store_true", help="Submit the prompts as a Batch API job and wait for it (resumable)")
+    parser.add_argument("--deadline", type=float, default=None, help="Stop the run after this many seconds, keeping what completed")
     
     args = parser.parse_args()
     
-    run_inference(args.config, args.input_file, args.results_file)
\ No newline at end of file
+    run_inference(args.config, args.input_file, args.results_file, os.environ.get("GEMINI_API_KEY"), resume=args.resume, use_cache=not args.no_cache, batch=args.batch, deadline=args.deadline)
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+Client-side flow control for the inference engine.
+
+`AdaptiveLimiter` replaces the fixed in-flight window with an AIMD controller
+(additive increase, multiplicative decrease), in the spirit of TCP congestion
+control: the window grows while requests complete quickly and shrinks when the
+server signals overload (429/503, timeouts) or latency spikes. The
+`concurrent_requests` value in the model YAML is its ceiling.
+
+`RateLimiter` enforces per-minute request and token quotas (`rpm`, `tpm` in
+the model YAML) with token buckets.
+"""
+
+import asyncio
+import time
+
+# Rough size of a token before the server has counted anything: the TPM
+# limiter's costs, the dispatch schedule, context caching and the preflight
+# all estimate with it
+CHARS_PER_TOKEN = 4
+
+
+class AdaptiveLimiter:
+    def __init__(self, ceiling, initial=None, floor=1, decrease_factor=0.5,
+                 latency_tolerance=None, adaptive=True):
+        """
+        :param ceiling: Hard cap on in-flight requests (`concurrent_requests`).
+        :param initial: Starting window, defaults to the ceiling.
+        :param floor: The window never shrinks below this.
+        :param decrease_factor: Multiplier applied to the window on overload.
+        :param latency_tolerance: Shrink when the smoothed latency exceeds this
+            multiple of the best smoothed latency seen so far. Off by default
+            since generation length alone makes LLM latency vary a lot.
+        :param adaptive: With False the window stays fixed at the ceiling.
+        """
+        self.ceiling = ceiling
+        self.floor = max(1, min(floor, ceiling))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.adaptive = adaptive
+
+        start = ceiling if (initial is None or not adaptive) else initial
+        self.limit = float(max(self.floor, min(start, ceiling)))
+        self.in_flight = 0
+
+        # Double the window per round trip until the first overload, like TCP slow start
+        self._slow_start = True
+        # Completions to wait after a decrease before reacting again
+        self._cooldown = 0
+        self._latency = None
+        self._best_latency = None
+        self._cond = asyncio.Condition()
+        self._start_time = time.monotonic()
+
+        self.min_limit = self.max_limit = int(self.limit)
+        self.overload_events = 0
+        self.latency_spikes = 0
+        self.history = [[0.0, int(self.limit)]]
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency):
+        """Record a healthy completion and its latency in seconds."""
+        if not self.adaptive:
+            return
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+
+        if self._cooldown > 0:
+            self._cooldown -= 1
+            return
+
+        if (self.latency_tolerance and self._best_latency
+                and self._latency > self.latency_tolerance * self._best_latency):
+            self.latency_spikes += 1
+            self._decrease()
+            return
+
+        if self._slow_start:
+            self._set_limit(self.limit + 1)
+        else:
+            # +1 per round trip, i.e. per `limit` healthy completions
+            self._set_limit(self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        """Record a 429/503 or a timeout."""
+        if not self.adaptive:
+            return
+        self.overload_events += 1
+        if self._cooldown > 0:
+            return
+        self._decrease()
+
+    def _decrease(self):
+        self._slow_start = False
+        self._set_limit(self.limit * self.decrease_factor)
+        # Requests already in flight were sent under the old window, ignore them
+        self._cooldown = max(self.in_flight, self.current)
+
+    def _set_limit(self, value):
+        old = self.current
+        self.limit = max(float(self.floor), min(float(self.ceiling), value))
+        new = self.current
+        if new != old:
+            self.min_limit = min(self.min_limit, new)
+            self.max_limit = max(self.max_limit, new)
+            self.history.append([round(time.monotonic() - self._start_time, 3), new])
+            if new > old:
+                self._wake()
+
+    def _wake(self):
+        async def notify():
+            async with self._cond:
+                self._cond.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+
+    def stats(self):
+        return {
+            "concurrency_ceiling": self.ceiling,
+            "concurrency_limit": self.current,
+            "concurrency_min_limit": self.min_limit,
+            "concurrency_max_limit": self.max_limit,
+            "overload_events": self.overload_events,
+            "latency_spikes": self.latency_spikes,
+            "concurrency_history": self.history,
+        }
+
+
+def make_limiter(concurrent_requests, adaptive_config=None):
+    """
+    Build the limiter from `concurrent_requests` and the optional
+    `adaptive_concurrency` section of a model YAML (`false` keeps a fixed window).
+    """
+    if adaptive_config is False:
+        return AdaptiveLimiter(concurrent_requests, adaptive=False)
+    adaptive_config = adaptive_config if isinstance(adaptive_config, dict) else {}
+    return AdaptiveLimiter(
+        concurrent_requests,
+        initial=adaptive_config.get("initial"),
+        floor=adaptive_config.get("floor", 1),
+        decrease_factor=adaptive_config.get("decrease_factor", 0.5),
+        latency_tolerance=adaptive_config.get("latency_tolerance"),
+    )
+
+
+class TokenBucket:
+    """Continuously refilled bucket holding up to `per_minute` units."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (a request larger than
+        the whole bucket only waits for a full bucket)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute limits.
+
+    Callers are served one at a time in arrival order, so a large request
+    is not starved by a stream of small ones; requests are spread smoothly
+    under the quota instead of bursting into 429s.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+        self.throttled = 0
+
+    async def acquire(self, tokens=0):
+        async with self._lock:
+            start = time.monotonic()
+            while True:
+                delay = max(
+                    self.requests.wait_time(1) if self.requests else 0.0,
+                    self.tokens.wait_time(tokens) if self.tokens else 0.0,
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.throttled += 1
+                self.waited += waited
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+
+    def stats(self):
+        return {
+            "rate_limit_rpm": self.requests.capacity if self.requests else None,
+            "rate_limit_tpm": self.tokens.capacity if self.tokens else None,
+            "rate_limit_wait_time": self.waited,
+            "rate_limit_throttled": self.throttled,
+        }
+
+
+def make_rate_limiter(rpm=None, tpm=None):
+    """Build a RateLimiter from the `rpm`/`tpm` keys of a model YAML, or None if neither is set."""
+    if not rpm and not tpm:
+        return None
+    return RateLimiter(rpm=rpm, tpm=tpm)
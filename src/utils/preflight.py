@@ -0,0 +1,284 @@
+"""
+Preflight token accounting and context-window guard.
+
+vLLM rejects a request whose prompt plus `max_tokens` exceeds the model's
+`--max-model-len`, so a full-paper prompt (or gpt-oss-20b's `max_tokens:
+48000` on a 32000-token window) only fails after a round trip. Before anything
+is sent, the preflight counts the prompt tokens of every pending row and
+prints the run's totals, the rows that cannot fit and, given prices, an
+estimated cost. Then every request gets `max_tokens` clamped to the room its
+prompt leaves in the window, and a row leaving less than `min_output_tokens`
+is either flagged (written with `"context_overflow": true`, no request sent)
+or cut to fit (`"truncated": true`): the end of its shared `prefix` (the
+paper) goes, or the end of its `prompt` if it has no prefix:
+
+    preflight:
+      tokenizer: openai/gpt-oss-20b   # Hugging Face tokenizer, needs transformers
+      max_model_len: 32000            # default: asked from the server
+      min_output_tokens: 1024
+      on_overflow: flag               # or truncate
+      price: {input: 0.05, output: 0.2}   # USD per million tokens
+
+Without a tokenizer, tokens are approximated from the prompt length, 4
+characters per token plus 10%, so that the guard errs on the safe side.
+`preflight: false` turns it all off.
+"""
+
+import math
+from array import array
+
+from .retry import ContextOverflow
+from .limits import CHARS_PER_TOKEN
+
+# Approximate counts are inflated by this much, prompts rarely need more
+APPROXIMATION_MARGIN = 1.1
+# Chat template around the prompt: role markers, gpt-oss's system message
+TEMPLATE_TOKENS = 128
+ON_OVERFLOW = ("flag", "truncate")
+
+
+class TokenCounter:
+    """Tokens of a text with a Hugging Face tokenizer, or approximated from its length."""
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+
+    @property
+    def exact(self):
+        return self.tokenizer is not None
+
+    def __call__(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN * APPROXIMATION_MARGIN)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+
+def make_token_counter(name=None):
+    """A TokenCounter with the tokenizer `name`, approximating when it cannot be loaded."""
+    if not name:
+        return TokenCounter()
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        print("Exact token counts need the transformers package (uv pip install transformers), approximating them")
+        return TokenCounter()
+    try:
+        return TokenCounter(AutoTokenizer.from_pretrained(name))
+    except (OSError, ValueError) as e:
+        print(f"Could not load tokenizer {name} ({e}), approximating token counts")
+        return TokenCounter()
+
+
+class Preflight:
+    def __init__(self, count, max_model_len=None, max_tokens=None, min_output_tokens=1024, on_overflow="flag",
+                 price=None, samples=1, shared_window=True, exact=False):
+        """
+        :param count: Function `count(data)` returning the prompt tokens of a row.
+        :param max_model_len: Context window in tokens, None to only count.
+        :param max_tokens: Output tokens asked for per sample, None if unbounded.
+        :param shared_window: Whether the output shares the window with the
+            prompt (vLLM), or the window only limits the prompt (Gemini's
+            `inputTokenLimit`). Only a shared window clamps `max_tokens`.
+        :param exact: Whether `count` uses the model's tokenizer.
+        """
+        if on_overflow not in ON_OVERFLOW:
+            raise ValueError(f"Unknown on_overflow {on_overflow!r}, expected one of {', '.join(ON_OVERFLOW)}")
+        self.count = count
+        self.max_model_len = max_model_len
+        self.max_tokens = max_tokens
+        self.min_output_tokens = min_output_tokens if shared_window else 0
+        self.on_overflow = on_overflow
+        self.price = price or {}
+        self.samples = samples
+        self.shared_window = shared_window
+        self.exact = exact
+
+        # Prompt tokens per request id, -1 for rows left out of the scan
+        self._tokens = array("q")
+        self.rows = 0
+        self.counted_tokens = 0
+        # Prompt tokens to be sent: overflowing rows flagged or truncated
+        self.prompt_tokens = 0
+        self.longest = 0
+        self.overflowing = 0
+        self.clamping = 0
+        # Upper bound of the run's output tokens, None if unbounded
+        self.output_tokens = 0
+        self.flagged = 0
+        self.truncated = 0
+        self.clamped = 0
+
+    def fits(self, tokens):
+        return self.max_model_len is None or tokens + self.min_output_tokens <= self.max_model_len
+
+    def output_budget(self, tokens):
+        """`max_tokens` for a prompt of `tokens`: the configured one, clamped to the room left in a shared window."""
+        if self.max_model_len is None or not self.shared_window:
+            return self.max_tokens
+        room = self.max_model_len - tokens
+        return room if self.max_tokens is None else min(self.max_tokens, room)
+
+    def scan(self, rows, skip=None):
+        """
+        Count the prompt tokens of `rows` (the data of every row, in file
+        order) and add them to the run's totals; rows for which `skip(data)`
+        is true (already answered) are left out.
+        """
+        for data in rows:
+            if skip and skip(data):
+                self._tokens.append(-1)
+                continue
+            tokens = self.count(data)
+            self._tokens.append(tokens)
+            self.rows += 1
+            self.counted_tokens += tokens
+            self.longest = max(self.longest, tokens)
+            if not self.fits(tokens):
+                self.overflowing += 1
+                if self.on_overflow == "flag":
+                    continue
+                # Counted as cut down to the largest prompt that fits
+                tokens = self.max_model_len - self.min_output_tokens
+            self.prompt_tokens += tokens
+            budget = self.output_budget(tokens)
+            if budget is None or self.output_tokens is None:
+                self.output_tokens = None
+            else:
+                self.output_tokens += budget * self.samples
+            if self.max_tokens is not None and budget is not None and budget < self.max_tokens:
+                self.clamping += 1
+
+    def check(self, request_id, data):
+        """
+        `(data, max_tokens, truncated)` to send for a row: `max_tokens` clamped
+        to the room its prompt leaves in the window and, with `on_overflow:
+        truncate`, the row cut to fit (see `_truncate`). ContextOverflow if the
+        row cannot fit.
+        """
+        tokens = self._tokens[request_id] if request_id < len(self._tokens) else -1
+        if tokens < 0:
+            tokens = self.count(data)
+        truncated = False
+        if not self.fits(tokens):
+            if self.on_overflow == "truncate":
+                data, tokens = self._truncate(data, tokens)
+                truncated = True
+            else:
+                self.flagged += 1
+                raise ContextOverflow(
+                    f"Prompt of {tokens} tokens leaves less than {self.min_output_tokens} tokens "
+                    f"of output in the {self.max_model_len}-token context window"
+                )
+        max_tokens = self.output_budget(tokens)
+        if self.max_tokens is not None and max_tokens is not None and max_tokens < self.max_tokens:
+            self.clamped += 1
+        return data, max_tokens, truncated
+
+    def _truncate(self, data, tokens):
+        """
+        The row cut to fit, and its tokens: the end of its shared `prefix` (the
+        paper) goes first, so that the query in `prompt` is kept whole; rows
+        without a prefix lose the end of their `prompt`.
+        """
+        field = "prefix" if data.get("prefix") else "prompt"
+        text = data.get(field) or ""
+        # Binary search on the length of the text, keeping the rest and the attachment
+        shortest = {**data, field: ""}
+        shortest_tokens = self.count(shortest)
+        if not self.fits(shortest_tokens):
+            self.flagged += 1
+            raise ContextOverflow(
+                f"Prompt of {tokens} tokens does not fit the {self.max_model_len}-token context window, "
+                f"even without its {field} ({shortest_tokens} tokens)"
+            )
+        fitting, fitting_tokens = shortest, shortest_tokens
+        lo, hi = 0, len(text)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            candidate = {**data, field: text[:mid]}
+            candidate_tokens = self.count(candidate)
+            if self.fits(candidate_tokens):
+                lo, fitting, fitting_tokens = mid, candidate, candidate_tokens
+            else:
+                hi = mid
+        self.truncated += 1
+        return fitting, fitting_tokens
+
+    def summary(self):
+        counted = "tokens" if self.exact else "tokens (approximate)"
+        lines = [f"Preflight: {self.rows} prompts, {self.counted_tokens:,} prompt {counted}, longest {self.longest:,}"]
+        if self.max_model_len is not None:
+            window = f"Context window {self.max_model_len:,} tokens: "
+            if self.overflowing:
+                action = "flagged" if self.on_overflow == "flag" else "truncated"
+                window += (
+                    f"{self.overflowing} prompts do not fit and will be {action}, "
+                    f"{self.prompt_tokens:,} prompt tokens left to send"
+                )
+            else:
+                window += "every prompt fits"
+            if self.clamping:
+                window += f", max_tokens clamped for {self.clamping} prompts"
+            lines.append(window)
+        if self.output_tokens is not None:
+            lines.append(f"Output: up to {self.output_tokens:,} tokens")
+        if self.price:
+            input_cost = self.prompt_tokens * self.price.get("input", 0) / 1e6
+            cost = f"Estimated cost: ${input_cost:.2f} input"
+            if self.output_tokens is not None:
+                cost += f" + up to ${self.output_tokens * self.price.get('output', 0) / 1e6:.2f} output"
+            lines.append(cost)
+        return "\n".join(lines)
+
+    def stats(self):
+        stats = {
+            "preflight_prompt_tokens": self.prompt_tokens,
+            "preflight_exact_counts": self.exact,
+            "max_model_len": self.max_model_len,
+            "context_overflows": self.flagged,
+            "truncated_prompts": self.truncated,
+            "clamped_max_tokens": self.clamped,
+        }
+        if self.price:
+            stats["estimated_input_cost"] = self.prompt_tokens * self.price.get("input", 0) / 1e6
+        return stats
+
+
+def make_preflight(preflight_config, count, max_tokens=None, context_window=None, samples=1,
+                   shared_window=True, tokenizer=True, guard=True):
+    """
+    Build a Preflight from the `preflight` section of a model YAML, or None if
+    it is `false`.
+
+    :param count: Function `count(data, tokens)` returning the prompt tokens
+        of a row, `tokens` being the configured `TokenCounter`.
+    :param context_window: Function returning the model's context window when
+        the config does not set `max_model_len`, or None if unknown.
+    :param tokenizer: Whether `count` uses the configured tokenizer; the
+        Gemini client estimates its own counts.
+    :param guard: Whether rows are checked against the context window, or
+        only counted (Gemini batch jobs).
+    """
+    if preflight_config is False:
+        return None
+    if not isinstance(preflight_config, dict):
+        preflight_config = {}
+    tokens = make_token_counter(preflight_config.get("tokenizer") if tokenizer else None)
+    max_model_len = preflight_config.get("max_model_len") if guard else None
+    if guard and max_model_len is None and context_window:
+        max_model_len = context_window()
+    if guard and max_model_len is None:
+        print("Context window unknown (set preflight.max_model_len), prompts are only counted")
+    return Preflight(
+        lambda data: count(data, tokens),
+        max_model_len=max_model_len,
+        max_tokens=max_tokens,
+        min_output_tokens=preflight_config.get("min_output_tokens", 1024),
+        on_overflow=preflight_config.get("on_overflow", "flag"),
+        price=preflight_config.get("price"),
+        samples=samples,
+        shared_window=shared_window,
+        exact=tokens.exact,
+    )
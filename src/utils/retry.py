@@ -0,0 +1,177 @@
+"""
+Error classification and retry policy for the inference clients.
+
+Errors are sorted into classes; transient ones (rate limiting, server errors,
+timeouts, stalled streams, dropped connections) are retried with capped
+exponential backoff and full jitter, honouring `Retry-After`, until the attempt
+budget or the per-request deadline runs out. Everything else (bad requests, safety blocks)
+fails immediately.
+
+Configured from the model YAML:
+
+    retry:
+      max_attempts: 5
+      base_delay: 2        # seconds, doubled on every attempt
+      max_delay: 120
+      deadline: 3600       # total seconds per request, across attempts
+"""
+
+import random
+import re
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+RETRYABLE_CLASSES = ("rate_limited", "server_error", "timeout", "stalled", "connection")
+
+
+class RequestError(Exception):
+    """Non-200 response from the inference server."""
+
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class InvalidResponseError(Exception):
+    """A 200 response without usable content, e.g. a safety block or no candidates."""
+
+
+class DeadlineExceeded(Exception):
+    """The per-request deadline ran out."""
+
+
+class AttemptTimeout(Exception):
+    """A single attempt ran longer than the `total` timeout, retried like other timeouts."""
+
+
+class StreamStalled(Exception):
+    """A streaming generation stopped producing events for longer than the idle timeout."""
+
+
+class CircuitOpen(Exception):
+    """No replica can take the request: all their circuits are open, see `balancer.LoadBalancer`."""
+
+
+class ContextOverflow(Exception):
+    """A prompt too long for the model's context window, found before sending it."""
+
+
+def parse_retry_after(response):
+    """
+    Seconds to wait according to the server: the `Retry-After` header
+    (delta-seconds or HTTP date), or Gemini's `RetryInfo.retryDelay` ("30s").
+    """
+    header = response.headers.get("retry-after")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(header)
+                return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    try:
+        details = response.json().get("error", {}).get("details", [])
+        for detail in details:
+            match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    except Exception:
+        pass
+    return None
+
+
+def classify_error(e):
+    """Map an exception to an error class name used for retries and stats."""
+    if isinstance(e, RequestError):
+        if e.status == 429:
+            return "rate_limited"
+        if e.status >= 500:
+            return "server_error"
+        return "client_error"
+    if isinstance(e, DeadlineExceeded):
+        return "deadline"
+    if isinstance(e, (httpx.TimeoutException, AttemptTimeout)):
+        return "timeout"
+    if isinstance(e, StreamStalled):
+        return "stalled"
+    if isinstance(e, httpx.TransportError):
+        # Refused/reset connections, RemoteDisconnected and friends
+        return "connection"
+    if isinstance(e, InvalidResponseError):
+        return "invalid_response"
+    if isinstance(e, ContextOverflow):
+        return "context_overflow"
+    if isinstance(e, CircuitOpen):
+        return "circuit_open"
+    return "other"
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, base_delay=2.0, max_delay=60.0, deadline=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+        self.retries = 0
+        # Every failed attempt, retried or not, by class
+        self.attempt_errors = Counter()
+        # Requests that ended in failure, by class of the last error
+        self.final_errors = Counter()
+
+    def next_delay(self, attempt, error, elapsed):
+        """
+        Seconds to sleep before attempt `attempt + 1`, or None to give up.
+
+        :param attempt: Number of attempts made so far (1-based).
+        :param error: The exception raised by the last attempt.
+        :param elapsed: Seconds spent on this request so far.
+        """
+        error_class = classify_error(error)
+        self.attempt_errors[error_class] += 1
+        if error_class not in RETRYABLE_CLASSES or attempt >= self.max_attempts:
+            return None
+
+        # Full jitter keeps a burst of 429s from retrying in lockstep
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            return None
+        self.retries += 1
+        return delay
+
+    def remaining(self, elapsed):
+        """Time left before the deadline, or None without one."""
+        return None if self.deadline is None else max(0.0, self.deadline - elapsed)
+
+    def record_failure(self, error):
+        self.final_errors[classify_error(error)] += 1
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "attempt_errors_by_class": dict(self.attempt_errors),
+            "failed_requests_by_class": dict(self.final_errors),
+        }
+
+
+def make_retry_policy(retry_config=None):
+    """Build a RetryPolicy from the `retry` section of a model YAML (`false` disables retries)."""
+    if retry_config is False:
+        return RetryPolicy(max_attempts=1)
+    retry_config = retry_config if isinstance(retry_config, dict) else {}
+    return RetryPolicy(
+        max_attempts=retry_config.get("max_attempts", 3),
+        base_delay=retry_config.get("base_delay", 2.0),
+        max_delay=retry_config.get("max_delay", 60.0),
+        deadline=retry_config.get("deadline"),
+    )
@@ -0,0 +1,69 @@
+"""
+Several samples per prompt from a single request.
+
+For self-consistency we want k samples of each prompt at temperature 0.9-1.0.
+Duplicating rows in the prompts file prefills the prompt k times; with
+`samples_per_prompt` in the model YAML, each request asks for k completions
+instead (vLLM's `n`, Gemini's `candidateCount`), which share one prefill:
+
+    samples_per_prompt: 5
+    sample_aggregation: majority   # or first (default), or "package.module:function"
+
+Every row of `responses.jsonl` then keeps all of them under `samples`, each
+with its `response`, `reasoning` and `finish_reason`. The row's own
+`response`, `reasoning` and `finish_reason` come from the aggregation:
+
+- `first`: the first usable sample
+- `majority`: the most frequent response (ignoring case and whitespace), with
+  its number of `votes`
+- `package.module:function`: a function receiving the usable samples and
+  returning the sample to report, e.g. a vote over parsed triplets, or a new
+  sample merging them
+"""
+
+import importlib
+from collections import Counter
+
+from .retry import InvalidResponseError
+
+
+def first(samples):
+    return samples[0]
+
+
+def majority(samples):
+    """The sample with the most frequent response, ties going to the earliest."""
+    def normalize(sample):
+        return " ".join(sample["response"].split()).lower()
+
+    votes = Counter(normalize(sample) for sample in samples)
+    winner = max(samples, key=lambda sample: votes[normalize(sample)])
+    return {**winner, "votes": votes[normalize(winner)]}
+
+
+AGGREGATORS = {"first": first, "majority": majority}
+
+
+def make_aggregator(spec="first"):
+    """The aggregation function named by `spec`: a built-in name or `package.module:function`."""
+    if spec in AGGREGATORS:
+        return AGGREGATORS[spec]
+    module_name, _, function_name = str(spec).partition(":")
+    if not function_name:
+        raise ValueError(f"Unknown sample aggregation {spec!r}, expected one of "
+                         f"{', '.join(AGGREGATORS)} or package.module:function")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def aggregate_samples(samples, aggregate):
+    """
+    Result fields of a row from its `samples`: the aggregated `response`,
+    `reasoning` and `finish_reason` (plus anything else the aggregation adds),
+    and the samples themselves. Samples without a response are kept but not
+    aggregated; InvalidResponseError if there is none with a response.
+    """
+    usable = [sample for sample in samples if sample.get("response") is not None]
+    if not usable:
+        errors = "; ".join(sample.get("error") or str(sample.get("finish_reason")) for sample in samples)
+        raise InvalidResponseError(f"No usable sample: {errors}")
+    return {**aggregate(usable), "samples": samples}
@@ -0,0 +1,127 @@
+"""
+Per-request telemetry and run-level summaries.
+
+Every record in `responses.jsonl` carries its `wall_time` (seconds from being
+admitted by the concurrency limiter to completion, retries included),
+`queue_wait` (seconds spent waiting for a slot), token counts and finish
+reason. Token counts are normalised across backends:
+
+- `prompt_tokens`: input tokens
+- `completion_tokens`: every generated token, reasoning included
+- `reasoning_tokens`: the reasoning part of `completion_tokens`, when reported
+- `cached_tokens`: the part of `prompt_tokens` served from a prefix or context cache
+
+`Telemetry` collects them over a run and summarises percentiles and token
+throughput for `*_stats.json`.
+"""
+
+import time
+from collections import Counter
+
+
+def openai_usage(response_json):
+    """Token counts from the `usage` block of a vLLM (OpenAI-compatible) response."""
+    usage = response_json.get("usage") or {}
+    details = usage.get("completion_tokens_details") or {}
+    # Only reported by vLLM with --enable-prompt-tokens-details
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "reasoning_tokens": details.get("reasoning_tokens"),
+        "cached_tokens": prompt_details.get("cached_tokens"),
+    }
+
+
+def gemini_usage(response_json):
+    """Token counts from the `usageMetadata` block of a Gemini response."""
+    usage = response_json.get("usageMetadata") or {}
+    candidates = usage.get("candidatesTokenCount")
+    thoughts = usage.get("thoughtsTokenCount")
+    # Gemini reports thinking tokens separately from the answer
+    completion = None
+    if candidates is not None or thoughts is not None:
+        completion = (candidates or 0) + (thoughts or 0)
+    return {
+        "prompt_tokens": usage.get("promptTokenCount"),
+        "completion_tokens": completion,
+        "reasoning_tokens": thoughts,
+        "cached_tokens": usage.get("cachedContentTokenCount"),
+    }
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100), or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+class Telemetry:
+    TOKEN_FIELDS = ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens")
+
+    def __init__(self):
+        self.wall_times = []
+        self.queue_waits = []
+        self.ttfts = []
+        self.tokens = {field: [] for field in self.TOKEN_FIELDS}
+        self.finish_reasons = Counter()
+        self._start = None
+        self._end = None
+
+    def start(self):
+        self._start = time.monotonic()
+
+    def stop(self):
+        self._end = time.monotonic()
+
+    def record(self, entry):
+        """Add one `responses.jsonl` record. Cache hits and failures only count toward queue wait."""
+        if entry.get("queue_wait") is not None:
+            self.queue_waits.append(entry["queue_wait"])
+        if entry.get("response") is None or entry.get("cached"):
+            return
+        # Not measured for responses collected from a batch job
+        if entry.get("wall_time") is not None:
+            self.wall_times.append(entry["wall_time"])
+        if entry.get("ttft") is not None:
+            self.ttfts.append(entry["ttft"])
+        for field in self.TOKEN_FIELDS:
+            if entry.get(field) is not None:
+                self.tokens[field].append(entry[field])
+        if entry.get("finish_reason"):
+            self.finish_reasons[entry["finish_reason"]] += 1
+
+    @staticmethod
+    def _percentiles(name, values):
+        return {f"{name}_p{q}": percentile(values, q) for q in (50, 90, 99)}
+
+    def stats(self):
+        elapsed = (self._end or time.monotonic()) - self._start if self._start else 0
+        stats = {}
+        stats.update(self._percentiles("latency", self.wall_times))
+        stats.update(self._percentiles("queue_wait", self.queue_waits))
+        if self.ttfts:
+            stats.update(self._percentiles("ttft", self.ttfts))
+        for field, values in self.tokens.items():
+            stats[f"total_{field}"] = sum(values)
+            stats[f"mean_{field}"] = sum(values) / len(values) if values else None
+        completion = sum(self.tokens["completion_tokens"])
+        stats["output_tokens_per_second"] = completion / elapsed if elapsed > 0 else 0
+        stats["finish_reasons"] = dict(self.finish_reasons)
+        return stats
+
+    def summary(self):
+        def fmt(value):
+            return "n/a" if value is None else f"{value:.2f}s"
+        stats = self.stats()
+        summary = (
+            f"Latency p50/p90/p99: {fmt(stats['latency_p50'])} / {fmt(stats['latency_p90'])} / {fmt(stats['latency_p99'])}, "
+            f"output tokens/s: {stats['output_tokens_per_second']:.1f}"
+        )
+        if stats["total_cached_tokens"] and stats["total_prompt_tokens"]:
+            share = stats["total_cached_tokens"] / stats["total_prompt_tokens"]
+            summary += f", cached prompt tokens: {share:.0%}"
+        return summary
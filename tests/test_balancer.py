@@ -0,0 +1,132 @@
+"""
+Circuit breaker against a replica that accepts connections but never answers,
+and health checks of replicas whose /health fails or does not exist.
+
+Run from the repository root:
+python -m unittest discover -s tests
+"""
+
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from src.utils.balancer import LoadBalancer
+from src.utils.engine import InferenceContext
+from src.utils.retry import AttemptTimeout, CircuitOpen, DeadlineExceeded
+
+
+async def start_silent_server():
+    """A TCP server reading requests and never replying."""
+    writers = []
+
+    async def handle(reader, writer):
+        writers.append(writer)
+        while await reader.read(65536):
+            pass
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, writers
+
+
+async def start_status_server(status):
+    """An HTTP server answering every request with `status` and an empty body."""
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(f"HTTP/1.1 {status} Status\r\ncontent-length: 0\r\nconnection: close\r\n\r\n".encode())
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+class SilentReplicaTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server, self.writers = await start_silent_server()
+        self.ctx = None
+
+    async def asyncTearDown(self):
+        if self.ctx:
+            await self.ctx.__aexit__(None, None, None)
+        for writer in self.writers:
+            writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def start(self, **config):
+        port = self.server.sockets[0].getsockname()[1]
+        # No /health probes, the trial request alone decides
+        config["load_balancing"] = {"eject_after": 2, "eject_seconds": 0.3, "probe_interval": 0, "hold": False}
+        self.ctx = InferenceContext(config, endpoints=[f"http://127.0.0.1:{port}"])
+        await self.ctx.__aenter__()
+        return self.ctx.balancer.endpoints[0]
+
+    async def post(self):
+        return await self.ctx.post("/v1/chat/completions", {"messages": []})
+
+    async def test_attempt_timeouts_open_the_circuit(self):
+        endpoint = await self.start(timeout={"total": 0.2}, retry=False)
+        for _ in range(2):
+            with self.assertRaises(AttemptTimeout):
+                await self.post()
+        self.assertTrue(endpoint.open)
+        self.assertEqual(endpoint.failures, 2)
+        self.assertEqual(self.ctx.limiter.overload_events, 2)
+        with self.assertRaises(CircuitOpen):
+            await self.post()
+
+    async def test_deadlines_open_the_circuit(self):
+        endpoint = await self.start(retry={"max_attempts": 1, "deadline": 0.2})
+        for _ in range(2):
+            with self.assertRaises(DeadlineExceeded):
+                await self.post()
+        self.assertTrue(endpoint.open)
+        with self.assertRaises(CircuitOpen):
+            await self.post()
+
+    async def test_timed_out_trial_keeps_the_circuit_open(self):
+        endpoint = await self.start(timeout={"total": 0.2}, retry=False)
+        for _ in range(2):
+            with self.assertRaises(AttemptTimeout):
+                await self.post()
+        await asyncio.sleep(0.35)
+        self.assertTrue(endpoint.available)
+        with self.assertRaises(AttemptTimeout):
+            await self.post()
+        self.assertTrue(endpoint.open)
+        self.assertGreater(endpoint.ejected_until, time.monotonic())
+        with self.assertRaises(CircuitOpen):
+            await self.post()
+
+
+class HealthCheckTest(unittest.IsolatedAsyncioTestCase):
+    async def check(self, status, checks):
+        """Endpoint after `checks` health checks of a replica answering `status`."""
+        server = await start_status_server(status)
+        port = server.sockets[0].getsockname()[1]
+        balancer = LoadBalancer([f"http://127.0.0.1:{port}"], eject_after=2, probe_interval=0)
+        try:
+            async with httpx.AsyncClient() as client:
+                balancer.start(client)
+                endpoint = balancer.endpoints[0]
+                for _ in range(checks):
+                    await balancer._check(endpoint)
+                await balancer.stop()
+        finally:
+            server.close()
+            await server.wait_closed()
+        return endpoint
+
+    async def test_failed_checks_open_the_circuit_after_eject_after(self):
+        self.assertFalse((await self.check(503, 1)).open)
+        self.assertTrue((await self.check(503, 2)).open)
+
+    async def test_missing_health_endpoint_is_not_a_failure(self):
+        endpoint = await self.check(404, 5)
+        self.assertFalse(endpoint.open)
+        self.assertEqual(endpoint.failed_checks, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Resumable polling of a Gemini batch job, against the mock server's fake Batch API.
+
+Run from the repository root:
+python -m unittest discover -s tests
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.benchmark.mock_server import MockServer
+from src.utils.gemini_batch import BatchJob
+from src.utils.inference_gemini import run_inference
+
+ROWS = 6
+
+
+class Killed(Exception):
+    """Stands for the process dying right after the job is submitted."""
+
+
+class BatchResumeTest(unittest.TestCase):
+    def setUp(self):
+        # run_inference runs its own event loop, the server gets one in a thread
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = self.on_server_loop(MockServer(batch_delay=0.5).__aenter__())
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.tmp.name, "config.yaml")
+        self.input_file = os.path.join(self.tmp.name, "prompts.jsonl")
+        self.results_file = os.path.join(self.tmp.name, "responses.jsonl")
+        with open(self.config, "w") as f:
+            json.dump({
+                "model_name": "gemini-mock",
+                "base_url": self.server.url,
+                "batch": {"poll_interval": 0.1},
+                "cache": False,
+                "preflight": False,
+            }, f)
+        with open(self.input_file, "w") as f:
+            for i in range(ROWS):
+                f.write(json.dumps({"prompt": f"Question {i}?"}) + "\n")
+
+    def tearDown(self):
+        self.on_server_loop(self.server.__aexit__(None, None, None))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.tmp.cleanup()
+
+    def on_server_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def run_batch(self):
+        run_inference(self.config, self.input_file, self.results_file, "mock-key", batch=True)
+
+    def test_rerun_resumes_the_recorded_job(self):
+        submit = BatchJob.submit
+
+        async def submit_and_die(job, *args):
+            await submit(job, *args)
+            raise Killed()
+
+        with mock.patch.object(BatchJob, "submit", submit_and_die):
+            with self.assertRaises(Killed):
+                self.run_batch()
+        self.assertTrue(os.path.exists(f"{self.results_file}.batch.json"))
+        self.assertFalse(os.path.exists(self.results_file))
+        self.assertEqual(len(self.server.batches), 1)
+
+        self.run_batch()
+        # Polled the recorded job instead of submitting another
+        self.assertEqual(len(self.server.batches), 1)
+        with open(self.results_file) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row["request_id"] for row in rows], list(range(ROWS)))
+        self.assertTrue(all(row["response"] for row in rows))
+        self.assertFalse(os.path.exists(f"{self.results_file}.batch.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()